@@ -0,0 +1,70 @@
+"""
+Action API functions provided by the dgu_local plugin.
+"""
+import logging
+
+from ckan import model
+import ckan.plugins.toolkit as toolkit
+
+from ckanext.dgulocal.lib.authorities import authority_index
+from ckanext.dgulocal.lib.search_cache import search_cache
+
+log = logging.getLogger(__name__)
+
+
+def local_authority_for_point(context, data_dict):
+    '''
+    Returns the local authority organizations whose boundary contains the
+    point, most local (smallest) first, e.g. a district council before its
+    county council.
+
+    :param lat: latitude (WGS 84)
+    :param lng: longitude (WGS 84)
+    :rtype: list of dicts with id, name and title
+    '''
+    toolkit.check_access('local_authority_for_point', context, data_dict)
+    errors = {}
+    point = {}
+    for key, limit in (('lat', 90), ('lng', 180)):
+        try:
+            point[key] = float(data_dict[key])
+        except KeyError:
+            errors[key] = ['Missing value']
+        except (TypeError, ValueError):
+            errors[key] = ['Not a number']
+        else:
+            if not -limit <= point[key] <= limit:
+                errors[key] = ['Out of range']
+    if errors:
+        raise toolkit.ValidationError(errors)
+
+    organizations = []
+    for organization_id in authority_index().lookup(point['lat'],
+                                                    point['lng']):
+        group = model.Group.get(organization_id)
+        if group is None or group.state != 'active':
+            continue
+        organizations.append({'id': group.id,
+                              'name': group.name,
+                              'title': group.title})
+    return organizations
+
+
+def local_search_cache_stats(context, data_dict):
+    '''
+    Returns the hits, misses, hit_rate and size of this worker's /local
+    search page cache, for sizing it with ckanext.dgulocal.search_cache_size
+    and search_cache_ttl.
+    '''
+    toolkit.check_access('local_search_cache_stats', context, data_dict)
+    return search_cache().stats()
+
+
+def local_authority_for_point_auth(context, data_dict):
+    # Boundaries are public
+    return {'success': True}
+
+
+def local_search_cache_stats_auth(context, data_dict):
+    # sysadmins only
+    return {'success': False}
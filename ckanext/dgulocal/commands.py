@@ -11,6 +11,38 @@ class Command(p.toolkit.CkanCommand):
 
         paster dgulocal init
            - Creates the database tables that DGU Local requires
+
+        paster dgulocal gather-all [N]
+           - Runs the gather stage for all active inventory harvest sources,
+             N at a time (default 4), and queues their objects to be
+             fetched and imported
+
+        paster dgulocal import-job <job-id> [N]
+           - Fetches and imports the job's waiting harvest objects using N
+             worker processes (default ckanext.dgulocal.import_processes
+             or 4), instead of the harvest fetch queue
+
+        paster dgulocal refresh-boundaries [all]
+           - Refreshes the cached authority boundaries that are older than
+             ckanext.dgulocal.boundary_ttl, or all of them
+
+        paster dgulocal load-boundaries <file> [mapping.csv] [code-property=NAME]
+           - Loads authority boundaries into organization_extent from a
+             GeoJSON file or shapefile (WGS 84), matching features to
+             organizations by GSS code - either their gss_code extra or
+             the gss_code,organization_name rows of mapping.csv. The GSS
+             code is the feature property NAME (e.g. LAD21CD), or else the
+             only property that looks like one
+
+        paster dgulocal refresh-esd
+           - Downloads the live ESD functions and services list from
+             standards.esd.org.uk and rebuilds the index of it, which is
+             otherwise built from the bundled copy
+
+        paster dgulocal reindex-local [N]
+           - Reindexes all the local authority datasets in the search
+             index, committing every N datasets (default
+             ckanext.dgulocal.reindex_commit_interval or 500)
     """
 
     summary = __doc__.split('\n')[0]
@@ -37,6 +69,37 @@ class Command(p.toolkit.CkanCommand):
 
         if cmd == 'init':
             self.init_db()
+        elif cmd == 'gather-all':
+            concurrency = int(self.args[1]) if len(self.args) > 1 else 4
+            self.gather_all(concurrency)
+        elif cmd == 'import-job':
+            if len(self.args) < 2:
+                print Command.__doc__
+                return
+            self.import_job(self.args[1],
+                            int(self.args[2]) if len(self.args) > 2 else None)
+        elif cmd == 'refresh-boundaries':
+            self.refresh_boundaries(self.args[1:] == ['all'])
+        elif cmd == 'reindex-local':
+            self.reindex_local(
+                int(self.args[1]) if len(self.args) > 1 else None)
+        elif cmd == 'refresh-esd':
+            self.refresh_esd()
+        elif cmd == 'load-boundaries':
+            if len(self.args) < 2:
+                print Command.__doc__
+                return
+            options = [arg for arg in self.args[2:] if '=' in arg]
+            args = [arg for arg in self.args[2:] if '=' not in arg]
+            code_property = None
+            for option in options:
+                name, value = option.split('=', 1)
+                if name != 'code-property':
+                    self.log.error('Option "%s" not recognized', name)
+                    return
+                code_property = value
+            self.load_boundaries(self.args[1], args[0] if args else None,
+                                 code_property)
         else:
             self.log.error('Command "%s" not recognized' % (cmd,))
 
@@ -44,3 +107,195 @@ class Command(p.toolkit.CkanCommand):
         import ckan.model as model
         from ckanext.dgulocal.model import init_tables
         init_tables(model.meta.engine)
+
+    def gather_all(self, concurrency):
+        import time
+        from multiprocessing.pool import ThreadPool
+
+        import requests
+        import ckan.model as model
+        from ckanext.harvest.model import HarvestSource, HarvestJob
+        from ckanext.harvest.logic import HarvestJobExists
+        from ckanext.dgulocal.harvester import InventoryHarvester
+
+        site_user = p.toolkit.get_action('get_site_user')(
+            {'model': model, 'ignore_auth': True}, {})
+        context = {'model': model, 'session': model.Session,
+                   'user': site_user['name']}
+        sources = model.Session.query(HarvestSource)\
+                       .filter_by(type=u'inventory')\
+                       .filter_by(active=True)\
+                       .all()
+        jobs = []
+        for source in sources:
+            try:
+                job = p.toolkit.get_action('harvest_job_create')(
+                    context, {'source_id': source.id})
+            except HarvestJobExists:
+                self.log.warning('Skipping source with a job already '
+                                 'pending: %s', source.url)
+                continue
+            # Mark it Running straight away, since harvest_jobs_run sends New
+            # jobs to the gather queue and it could otherwise be gathered
+            # twice before a thread gets to it. Without gather_finished set,
+            # harvest_jobs_run doesn't treat it as finished.
+            job_obj = HarvestJob.get(job['id'])
+            job_obj.status = u'Running'
+            job_obj.save()
+            jobs.append((job['id'], source.url))
+        model.Session.remove()
+
+        # Connections are pooled and shared by the threads. DB sessions are
+        # not shared, since model.Session is scoped to the thread.
+        http_session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=concurrency,
+                                                pool_maxsize=concurrency)
+        http_session.mount('http://', adapter)
+        http_session.mount('https://', adapter)
+        harvester = InventoryHarvester()
+        harvester.http_session = http_session
+        harvester.gather_stats = {}
+
+        print 'Gathering %s sources, %s at a time' % (len(jobs), concurrency)
+        start = time.time()
+        pool = ThreadPool(concurrency)
+        try:
+            results = pool.map(
+                lambda job: self._gather_job(harvester, *job), jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+        print '%-60s %8s %12s %8s' % ('Source', 'Seconds', 'Bytes', 'Objects')
+        for url, seconds, bytes_, num_objects in results:
+            print '%-60s %8.1f %12s %8s' % (url, seconds, bytes_, num_objects)
+        print 'Total: %.1f seconds, %s bytes, %s objects' % (
+            time.time() - start,
+            sum(r[2] for r in results),
+            sum(r[3] for r in results if isinstance(r[3], int)))
+
+    def _gather_job(self, harvester, job_id, url):
+        """
+        Gathers a single job and queues its objects, as the harvest gather
+        queue consumer would. Runs in a worker thread.
+
+        Returns (url, seconds, bytes, number of objects or 'error')
+        """
+        import time
+        import datetime
+
+        import ckan.model as model
+        from ckanext.harvest.model import HarvestJob
+        from ckanext.harvest.queue import get_fetch_publisher
+
+        start = time.time()
+        num_objects = 'error'
+        try:
+            job = HarvestJob.get(job_id)
+            job.gather_started = datetime.datetime.utcnow()
+            job.save()
+            object_ids = harvester.gather_stage(job)
+            if isinstance(object_ids, list):
+                publisher = get_fetch_publisher()
+                for object_id in object_ids:
+                    publisher.send({'harvest_object_id': object_id})
+                publisher.close()
+                num_objects = len(object_ids)
+            job.gather_finished = datetime.datetime.utcnow()
+            job.save()
+        except Exception, e:
+            self.log.exception('Gather failed for %s: %s', url, e)
+        finally:
+            model.Session.remove()
+        stats = harvester.gather_stats.pop(job_id, {})
+        return url, time.time() - start, stats.get('bytes', 0), num_objects
+
+    def import_job(self, job_id, processes):
+        from pylons import config
+        from ckanext.dgulocal.lib.parallel import import_job, DEFAULT_PROCESSES
+
+        if not processes:
+            processes = int(config.get('ckanext.dgulocal.import_processes',
+                                       DEFAULT_PROCESSES))
+        counts = import_job(job_id, processes)
+        print 'Objects imported: %s' % ', '.join(
+            '%s %s' % (count, state) for state, count in sorted(counts.items()))
+
+    def refresh_boundaries(self, refresh_all):
+        from ckanext.dgulocal.lib.geo import BoundaryCache, refresh_boundary
+
+        cache = BoundaryCache.from_config()
+        refreshed = failed = 0
+        for url in cache.urls():
+            polygon, fresh = cache.get(url)
+            if fresh and not refresh_all:
+                continue
+            if refresh_boundary(url, cache) is None:
+                self.log.error('Failed to refresh boundary: %s', url)
+                failed += 1
+            else:
+                refreshed += 1
+        print 'Boundaries refreshed: %s failed: %s' % (refreshed, failed)
+
+    def load_boundaries(self, path, mapping_path, code_property):
+        import time
+        from ckanext.dgulocal.lib.boundaries import (load_boundaries,
+                                                     BoundaryFileError)
+
+        start = time.time()
+        try:
+            counts = load_boundaries(path, mapping_path, code_property)
+        except BoundaryFileError, e:
+            self.log.error('Failed to load boundaries from %s: %s', path, e)
+            return
+        print 'Boundaries loaded: %s unmatched: %s invalid: %s (%.1fs)' % (
+            counts['loaded'], counts['unmatched'], counts['invalid'],
+            time.time() - start)
+
+    def refresh_esd(self):
+        from ckanext.dgulocal.lib.services import refresh_registry
+
+        registry = refresh_registry()
+        print 'ESD list refreshed: %s functions, %s services' % (
+            len(registry.functions), len(registry.services))
+
+    def reindex_local(self, commit_interval):
+        import time
+        from pylons import config
+        import ckan.model as model
+        from ckan.lib.search import index_for
+        from ckan.logic import get_action
+
+        if not commit_interval:
+            commit_interval = int(config.get(
+                'ckanext.dgulocal.reindex_commit_interval', 500))
+        package_ids = [package_id for package_id, in
+                       model.Session.query(model.PackageExtra.package_id)
+                            .filter(model.PackageExtra.key.in_(
+                                ['la_service', 'la_function']))
+                            .filter(model.PackageExtra.state == 'active')
+                            .distinct()]
+        self.log.info('Reindexing %s local datasets, committing every %s',
+                      len(package_ids), commit_interval)
+
+        package_index = index_for(model.Package)
+        context = {'model': model, 'ignore_auth': True, 'validate': False,
+                   'use_cache': False}
+        start = time.time()
+        reindexed = failed = 0
+        for i, package_id in enumerate(package_ids):
+            try:
+                pkg_dict = get_action('package_show')(context.copy(),
+                                                      {'id': package_id})
+                package_index.update_dict(pkg_dict, defer_commit=True)
+                reindexed += 1
+            except Exception, e:
+                self.log.exception('Failed to reindex %s: %s', package_id, e)
+                failed += 1
+            if (i + 1) % commit_interval == 0:
+                package_index.commit()
+                model.Session.remove()
+                self.log.info('Reindexed %s/%s', i + 1, len(package_ids))
+        package_index.commit()
+        print 'Datasets reindexed: %s failed: %s (%.1fs)' % (
+            reindexed, failed, time.time() - start)
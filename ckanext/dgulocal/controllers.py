@@ -3,7 +3,7 @@ from urllib import urlencode
 
 import ckan
 from ckan.common import OrderedDict
-from pylons import response, config
+from pylons import response, config, session
 from ckan import model
 from ckan.lib.helpers import flash_notice
 from ckan.lib.base import h, BaseController, abort, g
@@ -14,7 +14,16 @@ from ckanext.dgu.plugins_toolkit import (render, c, request, _,
 log = logging.getLogger(__name__)
 
 from ckanext.dgulocal.lib.services import load_services
+from ckanext.dgulocal.lib.search_cache import search_cache
 
 
 class LocalController(ckan.controllers.package.PackageController):
-    pass
\ No newline at end of file
+
+    def search(self):
+        # Logged-in users may see private datasets, and flash messages are
+        # only for the user they were flashed to
+        if c.userobj or request.method != 'GET' or session.get('_flash'):
+            return super(LocalController, self).search()
+        params = request.params.items() + [('_lang', h.lang())]
+        return search_cache().search(
+            params, super(LocalController, self).search)
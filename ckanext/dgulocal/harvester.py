@@ -2,13 +2,23 @@ import logging
 import re
 
 import requests
+from pylons import config
+from paste.deploy.converters import asbool
 
 from ckan.plugins.core import implements
 from ckanext.harvest.interfaces import IHarvester
 from ckanext.harvest.harvesters.dgu_base import DguHarvesterBase
 from ckanext.dgu.lib import helpers as dgu_helpers
 
-from ckanext.dgulocal.lib.inventory import InventoryDocument, InventoryXmlError
+from ckanext.dgulocal.lib.inventory import (InventoryDocument, InventoryStream,
+                                            InventoryXmlError)
+from ckanext.dgulocal.lib.bulk import HarvestObjectWriter, DEFAULT_CHUNK_SIZE
+from ckanext.dgulocal.lib.cache import JobScopedCache
+from ckanext.dgulocal.lib.names import NameReservations
+from ckanext.dgulocal.lib.themes import themes_for_uris
+from ckanext.dgulocal.lib.fetch import (FetchCache, conditional_get,
+                                        DEFAULT_MAX_SIZE)
+from ckanext.dgulocal.lib.search_cache import invalidate_search_cache
 
 log = logging.getLogger(__name__)
 
@@ -17,6 +27,17 @@ SCHEMA_TYPE_MAP = {
     'XML': 'xsd',
     }
 
+# Resource fields which are columns, rather than resource extras
+RESOURCE_CORE_FIELDS = ('url', 'format', 'description', 'resource_type',
+                        'name')
+
+# HarvestObjectExtra key for the digest of the dataset's content
+DIGEST_KEY = 'content_digest'
+
+# Inventory documents larger than this (bytes) are parsed as a stream rather
+# than building the whole tree in memory
+DEFAULT_STREAM_THRESHOLD = 5 * 1024 * 1024
+
 
 class InventoryHarvester(DguHarvesterBase):
     '''
@@ -27,6 +48,34 @@ class InventoryHarvester(DguHarvesterBase):
 
     IDENTIFIER_KEY = 'inventory_identifier'
 
+    # The package extras that get_package_dict sets, besides the themes
+    HARVESTED_EXTRAS = (IDENTIFIER_KEY, 'harvest_source_reference', 'licence',
+                        'la_service', 'la_function')
+
+    # The requests Session (or module) used to fetch inventories. The
+    # gather-all command swaps in a pooled Session shared between threads.
+    http_session = requests
+
+    # Memoizes lookups made for every object in the import stage. It is
+    # emptied at the start of each job.
+    lookup_cache = JobScopedCache(
+        maxsize=int(config.get('ckanext.dgulocal.lookup_cache_size', 1000)))
+
+    # Unique names for new packages, reserved for the job so that concurrent
+    # jobs and parallel import workers don't generate the same one
+    name_reservations = NameReservations()
+
+    # Count of packages not updated because they were unchanged, for the
+    # job currently being imported only: {'job_id': id, 'unchanged': count}
+    import_stats = {'job_id': None, 'unchanged': 0}
+
+    # Summary of each gather, keyed by HarvestJob id, for reporting:
+    # {'bytes': size of the document parsed, 'unchanged': True if it was not
+    # parsed because it was the same as last time}. Only recorded when a dict
+    # is given, as the gather-all command does, so that a long running gather
+    # consumer doesn't accumulate them.
+    gather_stats = None
+
     def info(self):
         '''
         Returns a descriptor with information about the harvester.
@@ -45,19 +94,20 @@ class InventoryHarvester(DguHarvesterBase):
         :param harvest_job: HarvestJob object
         :returns: A list of HarvestObject ids
         '''
-        from ckanext.harvest.model import (HarvestJob, HarvestObject,
-                                   HarvestObjectExtra as HOExtra,
-                                   HarvestGatherError)
-
-        from ckanext.dgulocal.lib.geo import get_boundary
-        from ckan import model
-
         self.last_run = None
 
         log.debug('Resolving source: %s', harvest_job.source.url)
+        # Validators from the last successful harvest of this source, so an
+        # unchanged document need not be parsed again
+        fetch_cache = FetchCache.from_config()
+        fetch_cache_entry = {} if getattr(self, 'force_import', False) else \
+            fetch_cache.get(harvest_job.source_id, harvest_job.source.url)
         try:
-            req = requests.get(harvest_job.source.url)
-            e = req.raise_for_status()
+            body, fetch_cache_entry, unchanged = conditional_get(
+                harvest_job.source.url, fetch_cache_entry,
+                session=self.http_session,
+                max_size=int(config.get('ckanext.dgulocal.max_download_size',
+                                        DEFAULT_MAX_SIZE)))
         except requests.exceptions.RequestException, e:
             # e.g. requests.exceptions.ConnectionError
             self._save_gather_error(
@@ -65,21 +115,52 @@ class InventoryHarvester(DguHarvesterBase):
                 (harvest_job.source.url, e.__class__.__name__, e),
                 harvest_job)
             return None
+        if self.gather_stats is not None:
+            self.gather_stats[harvest_job.id] = {
+                'bytes': fetch_cache_entry.get('size', 0) if body else 0,
+                'unchanged': unchanged}
+        if unchanged:
+            log.info('Inventory unchanged since last harvest: %s',
+                     harvest_job.source.url)
+            return []
+
+        try:
+            return self._gather_document(harvest_job, body,
+                                         fetch_cache, fetch_cache_entry)
+        finally:
+            body.close()
+
+    def _gather_document(self, harvest_job, body, fetch_cache,
+                         fetch_cache_entry):
+        '''
+        Creates HarvestObjects for the datasets in the fetched inventory
+        document.
+
+        :param body: file-like object containing the document
+        :returns: A list of HarvestObject ids, or None on error
+        '''
+        from ckanext.harvest.model import HarvestJob, HarvestGatherError
+
+        from ckanext.dgulocal.lib.geo import get_cached_boundary
+        from ckan import model
 
         try:
-            doc = InventoryDocument(req.content)
+            doc = self._parse_inventory(body, fetch_cache_entry['size'])
+            doc_metadata = doc.top_level_metadata()
         except InventoryXmlError, e:
             self._save_gather_error(
                 'Failed to parse or validate the XML document: %s %s' %
                 (e.__class__.__name__, e), harvest_job)
             return None
 
-        doc_metadata = doc.top_level_metadata()
-
         # TODO: Somehow update the publisher details with the geo boundary
         spatial_coverage_url = doc_metadata.get('spatial-coverage-url')
-        if False:  # DISABLED for time being, as broken  #spatial_coverage_url:
-            boundary = get_boundary(spatial_coverage_url)
+        # Boundaries come from a persistent cache, refreshed in the background
+        # or by "paster dgulocal refresh-boundaries", so this never waits on
+        # the statistics endpoints
+        if spatial_coverage_url and \
+                asbool(config.get('ckanext.dgulocal.update_boundaries', False)):
+            boundary = get_cached_boundary(spatial_coverage_url)
             if boundary:
                 # don't import dgulocal_model until here, to allow tests that
                 # don't need postgis to run under sqlite
@@ -104,61 +185,136 @@ class InventoryHarvester(DguHarvesterBase):
         # unchanged from the previous harvest, but it's hard to tell if the
         # previous harvest was not successful due to whatever reason, so don't
         # skip the doc because of its modified date.
+        # Objects may be in the previous harvest, or an older one, so get all
+        # the source's current ones in one go rather than querying per dataset
+        current_objects = self._get_current_objects(harvest_job.source_id) \
+            if previous else {}
 
         # We create a new HarvestObject for each inv:Dataset within the
-        # Inventory document
-        ids = []
+        # Inventory document, inserting them in chunks
+        writer = HarvestObjectWriter(
+            harvest_job,
+            chunk_size=config.get('ckanext.dgulocal.gather_chunk_size',
+                                  DEFAULT_CHUNK_SIZE))
         harvested_identifiers = set()
-        for dataset_node in doc.dataset_nodes():
-            dataset = doc.dataset_to_dict(dataset_node)
-
-            if dataset['identifier'] in harvested_identifiers:
-                HarvestGatherError.create(
-                    'Dataset with duplicate identifier "%s" - discarding'
-                    % dataset['identifier'], harvest_job)
-                continue
-            harvested_identifiers.add(dataset['identifier'])
-
-            guid = self.build_guid(doc_metadata['identifier'], dataset['identifier'])
-            # Use the most recent modification date out of the doc and dataset,
-            # since they might have forgotten to enter or update the dataset
-            # date.
-            dataset_last_modified = dataset['modified'] or doc_last_modified
-            if dataset_last_modified and doc_last_modified:
-                dataset_last_modified = max(dataset_last_modified, doc_last_modified)
-            if previous:
-                # object may be in the previous harvest, or an older one
-                existing_object = model.Session.query(HarvestObject)\
-                                       .filter_by(guid=guid)\
-                                       .filter_by(current=True)\
-                                       .first()
-                if not existing_object:
-                    status = 'new'
-                    package_id = None
-                elif (not existing_object.metadata_modified_date) or \
-                        existing_object.metadata_modified_date.date() < dataset_last_modified:
-                    status = 'changed'
-                    package_id = existing_object.package_id
-                else:
-                    log.debug('Dataset unchanged: %s this="%s" previous="%s"',
-                              dataset['title'], dataset_last_modified,
-                              existing_object.metadata_modified_date)
+        stats = dict.fromkeys(('new', 'changed', 'unchanged (date)',
+                               'unchanged (digest)'), 0)
+        try:
+            for dataset_node in doc.dataset_nodes():
+                dataset = InventoryDocument.dataset_to_dict(dataset_node)
+
+                if dataset['identifier'] in harvested_identifiers:
+                    HarvestGatherError.create(
+                        'Dataset with duplicate identifier "%s" - discarding'
+                        % dataset['identifier'], harvest_job)
                     continue
-            else:
-                status = 'new'
-                package_id = None
-            obj = HarvestObject(guid=guid,
-                                package_id=package_id,
-                                job=harvest_job,
-                                content=doc.serialize_node(dataset_node),
-                                harvest_source_reference=guid,
-                                metadata_modified_date=dataset_last_modified,
-                                extras=[HOExtra(key='status', value=status)],
-                                )
-            obj.save()
-            ids.append(obj.id)
-
-        return ids
+                harvested_identifiers.add(dataset['identifier'])
+
+                guid = self.build_guid(doc_metadata['identifier'], dataset['identifier'])
+                # Use the most recent modification date out of the doc and dataset,
+                # since they might have forgotten to enter or update the dataset
+                # date.
+                dataset_last_modified = dataset['modified'] or doc_last_modified
+                if dataset_last_modified and doc_last_modified:
+                    dataset_last_modified = max(dataset_last_modified, doc_last_modified)
+                digest = InventoryDocument.dataset_digest(dataset)
+                status, package_id = self._classify_dataset(
+                    current_objects.get(guid), digest, dataset_last_modified)
+                stats[status] += 1
+                if status.startswith('unchanged'):
+                    log.debug('Dataset %s: %s', status, dataset['title'])
+                    continue
+                writer.add(guid=guid,
+                           package_id=package_id,
+                           content=InventoryDocument.serialize_record(
+                               dataset, dataset_node),
+                           metadata_modified_date=dataset_last_modified,
+                           extras={'status': status,
+                                   DIGEST_KEY: digest},
+                           )
+            writer.flush()
+        except InventoryXmlError, e:
+            # only when streaming, since the document is validated as it is
+            # read. Chunks of objects already inserted are never queued, so
+            # delete them.
+            writer.discard()
+            self._save_gather_error(
+                'Failed to parse or validate the XML document: %s %s' %
+                (e.__class__.__name__, e), harvest_job)
+            return None
+
+        log.info('Gather stats for %s: %s', harvest_job.source.url,
+                 ', '.join('%s %s' % (count, key)
+                           for key, count in sorted(stats.items())))
+        # If any of the objects then fail to import, _forget_fetch clears
+        # this, so that they are retried next time
+        fetch_cache.set(harvest_job.source_id, fetch_cache_entry)
+        return writer.ids
+
+    @staticmethod
+    def _classify_dataset(current_object, digest, dataset_last_modified):
+        '''
+        Returns (status, package_id) for a dataset in the document, compared
+        with the source's current object for its guid. status is 'new',
+        'changed', 'unchanged (digest)' or 'unchanged (date)'.
+
+        :param current_object: (package_id, metadata_modified_date, digest)
+                               as given by _get_current_objects, or None
+        '''
+        if current_object is None:
+            return 'new', None
+        existing_package_id, existing_modified, existing_digest = \
+            current_object
+        if existing_digest:
+            # Some publishers bump the dates on every export, so when we know
+            # the previous content, go by that alone
+            if existing_digest == digest:
+                return 'unchanged (digest)', existing_package_id
+            return 'changed', existing_package_id
+        if (not existing_modified) or \
+                existing_modified.date() < dataset_last_modified:
+            return 'changed', existing_package_id
+        return 'unchanged (date)', existing_package_id
+
+    @staticmethod
+    def _get_current_objects(source_id):
+        '''
+        Returns the source's current HarvestObjects as a dict of
+        guid: (package_id, metadata_modified_date, content digest), using a
+        single query. The digest is None for objects harvested before digests
+        were recorded.
+        '''
+        from sqlalchemy import and_
+        from ckanext.harvest.model import (HarvestObject,
+                                           HarvestObjectExtra as HOExtra)
+        from ckan import model
+
+        rows = model.Session.query(HarvestObject.guid,
+                                   HarvestObject.package_id,
+                                   HarvestObject.metadata_modified_date,
+                                   HOExtra.value)\
+            .outerjoin(HOExtra, and_(HOExtra.harvest_object_id==HarvestObject.id,
+                                     HOExtra.key==DIGEST_KEY))\
+            .filter(HarvestObject.harvest_source_id==source_id)\
+            .filter(HarvestObject.current==True)
+        return dict((guid, (package_id, modified, digest))
+                    for guid, package_id, modified, digest in rows)
+
+    @staticmethod
+    def _parse_inventory(xml_file, size):
+        '''
+        Returns an InventoryDocument, or an InventoryStream if the document is
+        too large to comfortably hold as a tree in memory.
+
+        :param xml_file: file-like object containing the document
+        :param size: size of the document in bytes
+        '''
+        threshold = int(config.get('ckanext.dgulocal.stream_threshold',
+                                   DEFAULT_STREAM_THRESHOLD))
+        if size > threshold:
+            log.debug('Streaming large inventory document: %s bytes', size)
+            return InventoryStream(xml_file)
+        return InventoryDocument(xml_file)
 
     def fetch_stage(self, harvest_object):
         '''
@@ -168,7 +324,10 @@ class InventoryHarvester(DguHarvesterBase):
         '''
         # There is no fetching because all the content for the objects were got
         # in one request during the gather stage.
-        return bool(harvest_object.content)
+        if not harvest_object.content:
+            self._forget_fetch(harvest_object)
+            return False
+        return True
 
     @classmethod
     def build_guid(cls, doc_identifier, dataset_identifier):
@@ -197,11 +356,12 @@ class InventoryHarvester(DguHarvesterBase):
         from ckanext.harvest.model import (HarvestObjectExtra as HOExtra,
                                            HarvestGatherError)
 
-        res_formats = resource_formats()
+        # These lookups give the same results for every object in the job
+        lookup_cache = self.lookup_cache.for_job(harvest_object.job.id)
+        res_formats = lookup_cache.get(('resource_formats',),
+                                       resource_formats)
 
-        inv_dataset = InventoryDocument.dataset_to_dict(
-            InventoryDocument.parse_xml_string(harvest_object.content)
-            )
+        inv_dataset = InventoryDocument.record_to_dict(harvest_object.content)
 
         pkg = dict(
             title=inv_dataset['title'],
@@ -215,8 +375,9 @@ class InventoryHarvester(DguHarvesterBase):
         # License
         rights = inv_dataset.get('rights')
         if rights:
-            license_id, licence = \
-                dgu_helpers.get_licence_fields_from_free_text(rights)
+            license_id, licence = lookup_cache.get(
+                ('licence', rights),
+                dgu_helpers.get_licence_fields_from_free_text, rights)
             pkg['license_id'] = license_id
             if licence:
                 pkg['extras']['licence'] = licence
@@ -277,28 +438,149 @@ class InventoryHarvester(DguHarvesterBase):
         if not pkg.get('name'):
             # append the publisher name to differentiate similar titles better
             # than just a numbers suffix
-            publisher = model.Group.get(harvest_object.job.source.publisher_id)
-            publisher_abbrev = self._get_publisher_abbreviation(publisher)
-            pkg['name'] = self._gen_new_name(
-                '%s %s' % (pkg['title'], publisher_abbrev))
+            publisher_id = harvest_object.job.source.publisher_id
+            publisher_abbrev = lookup_cache.get(
+                ('publisher_abbreviation', publisher_id),
+                lambda: self._get_publisher_abbreviation(
+                    model.Group.get(publisher_id)))
+            pkg['name'] = self.name_reservations.for_job(
+                harvest_object.job.id).reserve(
+                    '%s %s' % (pkg['title'], publisher_abbrev))
 
         # Themes based on services/functions
         if 'tags' not in pkg:
             pkg['tags'] = []
-        try:
-            themes = dgutheme.categorize_package(pkg)
-            log.debug('%s given themes: %r', pkg['name'], themes)
-        except ImportError, e:
-            log.debug('Theme cannot be given: %s', e)
-            themes = []
+        # Primary and secondary themes from the precomputed index, falling
+        # back to the generic categoriser for unknown services/functions
+        themes = themes_for_uris(
+            inv_dataset['services'] + inv_dataset['functions'])[:2]
+        if themes:
+            log.debug('%s given themes from services/functions: %r',
+                      pkg['name'], themes)
+        else:
+            try:
+                themes = dgutheme.categorize_package(pkg)
+                log.debug('%s given themes: %r', pkg['name'], themes)
+            except ImportError, e:
+                log.debug('Theme cannot be given: %s', e)
+                themes = []
         if themes:
             pkg['extras'][dgutheme.PRIMARY_THEME] = themes[0]
             if len(themes) == 2:
                 pkg['extras'][dgutheme.SECONDARY_THEMES] = '["%s"]' % themes[1]
 
+        if existing_dataset and not self._package_changed(pkg,
+                                                          existing_dataset):
+            # Save a needless revision and reindex
+            raise PackageUnchanged(existing_dataset.id)
+
         pkg['extras'] = self.extras_from_dict(pkg['extras'])
         return pkg
 
+    def import_stage(self, harvest_object):
+        try:
+            result = super(InventoryHarvester, self).import_stage(
+                harvest_object)
+        except PackageUnchanged, e:
+            self._save_unchanged(harvest_object, e.package_id)
+            return True
+        except:
+            self._forget_fetch(harvest_object)
+            raise
+        if not result:
+            self._forget_fetch(harvest_object)
+            return result
+        # The package was created, updated or deleted, so the /local pages
+        # cached by the web workers are out of date. It is only a file touch.
+        try:
+            invalidate_search_cache()
+        except Exception, e:
+            log.exception('Failed to invalidate the search cache: %s', e)
+        return result
+
+    @staticmethod
+    def _forget_fetch(harvest_object):
+        '''
+        Clears the source's fetch cache entry when one of its objects fails,
+        so that the next harvest fetches and gathers the document again
+        rather than finding it unchanged, and the failed datasets are retried.
+        '''
+        log.info('Object %s failed, so the next harvest of source %s will '
+                 'not be skipped', harvest_object.id,
+                 harvest_object.harvest_source_id)
+        FetchCache.from_config().clear(harvest_object.harvest_source_id)
+
+    def _save_unchanged(self, harvest_object, package_id):
+        '''
+        Makes the harvest object current for its package without updating
+        the package, since get_package_dict found nothing to change.
+        '''
+        from ckanext.harvest.model import HarvestObject
+        from ckan import model
+
+        model.Session.query(HarvestObject)\
+             .filter(HarvestObject.package_id==package_id)\
+             .filter(HarvestObject.current==True)\
+             .update({'current': False}, synchronize_session='fetch')
+        harvest_object.package_id = package_id
+        harvest_object.current = True
+        harvest_object.save()
+
+        stats = self._import_stats_for_job(harvest_object.job.id)
+        stats['unchanged'] += 1
+        log.info('Package unchanged, so not updated: %s (%s skipped in job %s)',
+                 package_id, stats['unchanged'], harvest_object.job.id)
+
+    def _import_stats_for_job(self, job_id):
+        '''
+        Returns the import_stats, having logged and reset those of any other
+        job.
+        '''
+        stats = self.import_stats
+        if job_id != stats['job_id']:
+            if stats['job_id'] is not None:
+                log.info('Job %s: %s unchanged packages were not updated',
+                         stats['job_id'], stats['unchanged'])
+            stats['job_id'] = job_id
+            stats['unchanged'] = 0
+        return stats
+
+    @classmethod
+    def _package_changed(cls, pkg, existing_dataset):
+        '''
+        Returns whether the package dict built by get_package_dict differs
+        from the existing package. Only the fields and extras that
+        get_package_dict sets are compared - not those merged in from the
+        defaults, which may differ on every harvest - with resources matched
+        by id and in order.
+        '''
+        import ckanext.dgu.lib.theme as dgutheme
+
+        for key in ('title', 'notes', 'license_id', 'state'):
+            if not _same(pkg.get(key), getattr(existing_dataset, key)):
+                return True
+        existing_extras = existing_dataset.extras
+        for key in cls.HARVESTED_EXTRAS + (dgutheme.PRIMARY_THEME,
+                                           dgutheme.SECONDARY_THEMES):
+            if not _same(pkg['extras'].get(key), existing_extras.get(key)):
+                return True
+        existing_resources = existing_dataset.resources
+        if len(pkg['resources']) != len(existing_resources):
+            return True
+        for res, existing_res in zip(pkg['resources'], existing_resources):
+            if res.get('id') != existing_res.id:
+                return True
+            for key, value in res.iteritems():
+                if key == 'id':
+                    continue
+                if key in RESOURCE_CORE_FIELDS:
+                    existing_value = getattr(existing_res, key)
+                else:
+                    existing_value = existing_res.extras.get(key)
+                if not _same(value, existing_value):
+                    return True
+        return False
+
     @staticmethod
     def _get_publisher_abbreviation(publisher):
         abbrev = publisher.extras.get('abbreviation')
@@ -306,3 +588,18 @@ class InventoryHarvester(DguHarvesterBase):
             # Just look for capital letters
             abbrev = re.sub('[^A-Z]', '', publisher.title)
         return abbrev
+
+
+class PackageUnchanged(Exception):
+    '''
+    Raised by get_package_dict when the existing package would not change,
+    so that import_stage skips the update.
+    '''
+    def __init__(self, package_id):
+        super(PackageUnchanged, self).__init__(package_id)
+        self.package_id = package_id
+
+
+def _same(value, existing_value):
+    # empty values may come back from the db as None
+    return (value or '') == (existing_value or '')
@@ -0,0 +1,172 @@
+"""
+In-memory spatial index of the organization_extent boundaries, for looking
+up which local authorities cover a point.
+
+The boundaries are put in an STRtree of their bounding boxes, so a lookup only
+does the exact point-in-polygon test (against a prepared geometry) for the
+few authorities whose bounding box contains the point.
+
+Note that boundaries are stored as they come from statistics.data.gov.uk,
+with latitude as x and longitude as y.
+"""
+import os
+import logging
+import tempfile
+import threading
+import time
+
+from shapely import wkb
+from shapely.geometry import Point
+from shapely.prepared import prep
+from shapely.strtree import STRtree
+
+from ckanext.dgulocal.lib.stamp import ChangeStamp
+
+log = logging.getLogger(__name__)
+
+# Touched when boundaries are stored, so that every process rebuilds its index
+DEFAULT_STAMP_FILE = os.path.join(tempfile.gettempdir(),
+                                  'dgulocal_authority_index.stamp')
+# Rebuild the index at least this often (seconds), in case the stamp file
+# isn't shared by the processes that store boundaries and the web workers
+DEFAULT_MAX_AGE = 60 * 60
+# Simplified boundaries are accurate enough (about 10m) and much smaller
+DEFAULT_RESOLUTION = 'fine'
+
+
+class AuthorityIndex(object):
+    """
+    Spatial index of organization boundaries.
+
+        index = AuthorityIndex([(organization_id, polygon), ...])
+        index.lookup(52.57, -0.24)  # -> [organization_id, ...]
+    """
+
+    def __init__(self, extents):
+        self._entries = {}
+        geoms = []
+        for organization_id, geom in extents:
+            if geom is None or geom.is_empty:
+                continue
+            # STRtree.query returns the geometries themselves
+            self._entries[id(geom)] = (organization_id, prep(geom), geom.area)
+            geoms.append(geom)
+        # keep the geometries alive, so their ids stay unique
+        self._geoms = geoms
+        self._tree = STRtree(geoms) if geoms else None
+
+    def __len__(self):
+        return len(self._geoms)
+
+    def lookup(self, lat, lng):
+        """
+        Returns the ids of the organizations whose boundary contains the
+        point, smallest area first, i.e. a district before its county.
+        """
+        if self._tree is None:
+            return []
+        point = Point(lat, lng)
+        matches = []
+        for candidate in self._tree.query(point):
+            organization_id, prepared, area = self._entries[id(candidate)]
+            if prepared.intersects(point):
+                matches.append((area, organization_id))
+        return [organization_id for area, organization_id in sorted(matches)]
+
+    @classmethod
+    def from_db(cls, resolution=DEFAULT_RESOLUTION):
+        """
+        Builds the index from the organization_extent table, using the
+        boundaries at the given resolution, or the full ones where they have
+        not been simplified.
+        """
+        from ckan import model
+        from ckanext.dgulocal.model import geometry_column_name
+
+        rows = model.Session.execute(
+            'SELECT organization_id, ST_AsBinary(COALESCE(%s, the_geom)) '
+            'FROM organization_extent' % geometry_column_name(resolution))
+        extents = [(organization_id, wkb.loads(str(geom)))
+                   for organization_id, geom in rows if geom is not None]
+        index = cls(extents)
+        log.info('Built authority index of %s boundaries', len(index))
+        return index
+
+
+class LazyAuthorityIndex(object):
+    """
+    Holds an AuthorityIndex that is built from the db the first time it is
+    needed, and again after invalidate() is called in any process (which
+    touches the stamp file) or it is max_age seconds old.
+    """
+
+    def __init__(self, max_age=DEFAULT_MAX_AGE,
+                 resolution=DEFAULT_RESOLUTION,
+                 stamp_file=DEFAULT_STAMP_FILE):
+        self.max_age = max_age
+        self.resolution = resolution
+        self.stamp = ChangeStamp(stamp_file)
+        self._index = None
+        self._built = 0
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self.stamp.changed():
+            log.info('Boundaries changed, so rebuilding the authority index')
+            self._index = None
+        index = self._index
+        if index is None or time.time() - self._built > self.max_age:
+            with self._lock:
+                index = self._index
+                if index is None or time.time() - self._built > self.max_age:
+                    index = self._index = \
+                        AuthorityIndex.from_db(self.resolution)
+                    self._built = time.time()
+        return index
+
+    def lookup(self, lat, lng):
+        return self.get().lookup(lat, lng)
+
+    def invalidate(self):
+        """
+        Forgets the index, so it is rebuilt on the next lookup, and touches
+        the stamp file so that other processes rebuild theirs.
+        """
+        self._index = None
+        self.stamp.touch()
+        # this process's index is already forgotten
+        self.stamp.changed()
+
+
+def _from_config():
+    from pylons import config
+    return LazyAuthorityIndex(
+        int(config.get('ckanext.dgulocal.authority_index_max_age',
+                       DEFAULT_MAX_AGE)),
+        config.get('ckanext.dgulocal.authority_index_resolution',
+                   DEFAULT_RESOLUTION),
+        config.get('ckanext.dgulocal.authority_index_stamp',
+                   DEFAULT_STAMP_FILE))
+
+_authority_index = None
+_authority_index_lock = threading.Lock()
+
+
+def authority_index():
+    """
+    Returns this process's LazyAuthorityIndex.
+    """
+    global _authority_index
+    if _authority_index is None:
+        with _authority_index_lock:
+            if _authority_index is None:
+                _authority_index = _from_config()
+    return _authority_index
+
+
+def invalidate_authority_index():
+    """
+    Called when an organization's extent is changed, to have every process
+    rebuild its index.
+    """
+    authority_index().invalidate()
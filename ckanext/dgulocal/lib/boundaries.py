@@ -0,0 +1,223 @@
+"""
+Bulk loading of authority boundaries into organization_extent from a local
+GeoJSON file or shapefile, e.g. the ONS local authority district boundaries,
+for "paster dgulocal load-boundaries".
+
+Features are matched to organizations by GSS code (e.g. E06000031), which is
+in the feature property named on the command line, or else whichever
+property looks like one - as long as only one does, since e.g. a district
+file may have both the district's code and its county's. Organizations are given
+their GSS code in the "gss_code" extra, or by a CSV file of
+gss_code,organization_name rows.
+
+Rows are upserted many at a time with INSERT ... ON CONFLICT (PostgreSQL 9.5+)
+and the simplified geometries are computed by PostGIS in the same statement.
+"""
+import csv
+import json
+import logging
+import re
+from collections import OrderedDict
+
+from shapely.geometry import shape
+from shapely.ops import transform
+
+from ckanext.dgulocal.lib.geo import RESOLUTIONS
+
+log = logging.getLogger(__name__)
+
+GSS_CODE = re.compile(r'^[EWSN]\d{8}$')
+GSS_EXTRA = 'gss_code'
+DEFAULT_BATCH_SIZE = 100
+
+
+class BoundaryFileError(Exception):
+    pass
+
+
+def iter_features(path):
+    """
+    Yields (properties, geometry dict) for each feature in the GeoJSON file
+    or shapefile, without loading the whole file where possible.
+    """
+    if path.lower().endswith('.shp'):
+        return _iter_shapefile_features(path)
+    return _iter_geojson_features(path)
+
+
+def _iter_geojson_features(path):
+    try:
+        import ijson
+    except ImportError:
+        ijson = None
+        log.debug('ijson is not installed, so %s is loaded whole', path)
+    with open(path, 'rb') as f:
+        if ijson:
+            features = ijson.items(f, 'features.item')
+        else:
+            try:
+                features = json.load(f).get('features', [])
+            except ValueError, e:
+                raise BoundaryFileError('Not a GeoJSON file: %s' % e)
+        for feature in features:
+            yield feature.get('properties') or {}, feature.get('geometry')
+
+
+def _iter_shapefile_features(path):
+    try:
+        import shapefile
+    except ImportError:
+        raise BoundaryFileError('Reading shapefiles needs pyshp: '
+                                'pip install pyshp')
+    reader = shapefile.Reader(path)
+    field_names = [field[0] for field in reader.fields[1:]]
+    for shape_record in reader.iterShapeRecords():
+        yield (dict(zip(field_names, shape_record.record)),
+               shape_record.shape.__geo_interface__)
+
+
+def gss_code(properties, code_property=None):
+    """
+    Returns the GSS code in the code_property, or if that is not given, the
+    value of the only property that is a GSS code. Returns None if there is
+    no GSS code, or more than one property could be it.
+    """
+    if code_property:
+        candidates = [properties.get(code_property)]
+    else:
+        candidates = properties.values()
+    codes = set(value.strip() for value in candidates
+                if isinstance(value, basestring) and
+                GSS_CODE.match(value.strip()))
+    if len(codes) == 1:
+        return codes.pop()
+    if codes:
+        log.debug('More than one property is a GSS code, so give the '
+                  'code property: %r', properties)
+    return None
+
+
+def boundary_shape(geometry):
+    """
+    Returns the Shapely shape of a GeoJSON geometry, with latitude as x, as
+    the boundaries from statistics.data.gov.uk are stored. GeoJSON has
+    longitude first.
+    """
+    lng_lat = shape(geometry)
+    minx, miny, maxx, maxy = lng_lat.bounds
+    if not (-180 <= minx <= maxx <= 180 and -90 <= miny <= maxy <= 90):
+        raise BoundaryFileError('Coordinates are not WGS 84 longitude/latitude '
+                                '(e.g. British National Grid) - reproject '
+                                'the file first, e.g. with ogr2ogr -t_srs '
+                                'EPSG:4326')
+    return transform(lambda x, y: (y, x), lng_lat)
+
+
+def organizations_by_gss(mapping_path=None):
+    """
+    Returns a dict of GSS code: organization id, from the organizations'
+    gss_code extras and, taking precedence, the mapping CSV file.
+    """
+    from ckan import model
+
+    organizations = dict(
+        (code.strip(), group_id) for code, group_id in
+        model.Session.query(model.GroupExtra.value, model.GroupExtra.group_id)
+                     .filter(model.GroupExtra.key == GSS_EXTRA)
+                     .filter(model.GroupExtra.state == 'active'))
+    if mapping_path:
+        with open(mapping_path, 'rb') as f:
+            for row in csv.reader(f):
+                if len(row) < 2 or not GSS_CODE.match(row[0].strip()):
+                    continue  # e.g. the header
+                group = model.Group.get(row[1].strip())
+                if group is None:
+                    log.warning('Organization not found: %s', row[1])
+                    continue
+                organizations[row[0].strip()] = group.id
+    return organizations
+
+
+def upsert_extents(rows, srid, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Inserts or replaces the organization_extent rows for the given
+    (organization_id, shape) tuples, batch_size per statement, and commits.
+    Returns the number of rows.
+    """
+    from ckan import model
+
+    count = 0
+    # ON CONFLICT can't update the same row twice in a statement, so a
+    # later feature for the same organization replaces the earlier one
+    batch = OrderedDict()
+    for organization_id, geom in rows:
+        batch[organization_id] = geom
+        if len(batch) >= batch_size:
+            count += _upsert_batch(batch.items(), srid)
+            batch = OrderedDict()
+    if batch:
+        count += _upsert_batch(batch.items(), srid)
+    model.Session.commit()
+    return count
+
+
+def _upsert_batch(batch, srid):
+    from ckan import model
+    from ckanext.dgulocal.model import geometry_column_name
+
+    params = {'srid': srid}
+    values = []
+    for i, (organization_id, geom) in enumerate(batch):
+        values.append('(:id%d, :wkb%d)' % (i, i))
+        params['id%d' % i] = organization_id
+        params['wkb%d' % i] = geom.wkb.encode('hex')
+    columns = [geometry_column_name(name) for name, tolerance in RESOLUTIONS]
+    simplified = ['ST_SimplifyPreserveTopology(geom, %r)' % tolerance
+                  for name, tolerance in RESOLUTIONS]
+    model.Session.execute(
+        'INSERT INTO organization_extent '
+        '(organization_id, the_geom, %(columns)s) '
+        'SELECT organization_id, geom, %(simplified)s FROM '
+        '(SELECT organization_id, '
+        'ST_GeomFromWKB(decode(wkb, \'hex\'), :srid) AS geom '
+        'FROM (VALUES %(values)s) AS raw (organization_id, wkb)) AS extents '
+        'ON CONFLICT (organization_id) DO UPDATE SET '
+        'the_geom = EXCLUDED.the_geom, %(updates)s' % {
+            'columns': ', '.join(columns),
+            'simplified': ', '.join(simplified),
+            'values': ', '.join(values),
+            'updates': ', '.join('%s = EXCLUDED.%s' % (column, column)
+                                 for column in columns)},
+        params)
+    return len(batch)
+
+
+def load_boundaries(path, mapping_path=None, code_property=None,
+                    batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Loads the boundaries in the file into organization_extent. Returns a
+    dict of counts: loaded, unmatched (no organization for the GSS code)
+    and invalid (no GSS code or geometry).
+    """
+    from ckanext.dgulocal.model import db_srid
+    from ckanext.dgulocal.lib.authorities import invalidate_authority_index
+
+    organizations = organizations_by_gss(mapping_path)
+    counts = {'loaded': 0, 'unmatched': 0, 'invalid': 0}
+
+    def rows():
+        for properties, geometry in iter_features(path):
+            code = gss_code(properties, code_property)
+            if not code or not geometry:
+                counts['invalid'] += 1
+                continue
+            organization_id = organizations.get(code)
+            if not organization_id:
+                log.debug('No organization for GSS code %s', code)
+                counts['unmatched'] += 1
+                continue
+            yield organization_id, boundary_shape(geometry)
+
+    counts['loaded'] = upsert_extents(rows(), db_srid, batch_size)
+    invalidate_authority_index()
+    return counts
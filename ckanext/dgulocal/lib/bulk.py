@@ -0,0 +1,103 @@
+"""
+Bulk writing of HarvestObjects during the gather stage.
+
+Saving each HarvestObject through the ORM costs an INSERT for the object, one
+for its extras and a commit. For inventories with thousands of datasets that
+dominates the gather, so instead rows are batched up and inserted with
+executemany, committing once per chunk.
+"""
+import logging
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 1000
+
+
+class HarvestObjectWriter(object):
+    """
+    Collects HarvestObjects for a job and inserts them, and their extras, in
+    chunks. Call flush() once all objects are added; the ids of the inserted
+    objects are in ``ids``, in the order they were added.
+    """
+
+    def __init__(self, harvest_job, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.harvest_job = harvest_job
+        self.chunk_size = max(int(chunk_size), 1)
+        self.ids = []
+        self._objects = []
+        self._extras = []
+
+    def add(self, guid, package_id, content, metadata_modified_date,
+            extras):
+        """
+        Queues a HarvestObject for insertion and returns its id.
+
+        :param extras: dict of HarvestObjectExtra key/values e.g. status
+        """
+        from ckan.model.types import make_uuid
+
+        object_id = make_uuid()
+        self._objects.append({
+            'id': object_id,
+            'guid': guid,
+            'current': False,
+            'package_id': package_id,
+            'content': content,
+            'harvest_source_reference': guid,
+            'metadata_modified_date': metadata_modified_date,
+            'harvest_job_id': self.harvest_job.id,
+            # normally set by the HarvestObject before_insert listener,
+            # which core inserts bypass
+            'harvest_source_id': self.harvest_job.source_id,
+            })
+        for key, value in extras.iteritems():
+            self._extras.append({'id': make_uuid(),
+                                 'harvest_object_id': object_id,
+                                 'key': key,
+                                 'value': value})
+        self.ids.append(object_id)
+        if len(self._objects) >= self.chunk_size:
+            self.flush()
+        return object_id
+
+    def flush(self):
+        """
+        Inserts the queued objects and extras, and commits.
+        """
+        from ckan import model
+        from ckanext.harvest.model import (harvest_object_table,
+                                           harvest_object_extra_table)
+
+        if not self._objects:
+            return
+        log.debug('Inserting %s harvest objects', len(self._objects))
+        model.Session.execute(harvest_object_table.insert(), self._objects)
+        if self._extras:
+            model.Session.execute(harvest_object_extra_table.insert(),
+                                  self._extras)
+        model.Session.commit()
+        self._objects = []
+        self._extras = []
+
+    def discard(self):
+        """
+        Deletes the objects already inserted, and their extras, and forgets
+        any queued ones, e.g. when the gather fails part way through. They
+        would otherwise be left WAITING, never to be imported, and stop the
+        job from ever finishing.
+        """
+        from ckan import model
+        from ckanext.harvest.model import (harvest_object_table,
+                                           harvest_object_extra_table)
+
+        self._objects = []
+        self._extras = []
+        if not self.ids:
+            return
+        log.debug('Deleting %s harvest objects', len(self.ids))
+        model.Session.execute(harvest_object_extra_table.delete().where(
+            harvest_object_extra_table.c.harvest_object_id.in_(self.ids)))
+        model.Session.execute(harvest_object_table.delete().where(
+            harvest_object_table.c.id.in_(self.ids)))
+        model.Session.commit()
+        self.ids = []
@@ -0,0 +1,120 @@
+"""
+Small in-process caches for values that are expensive to look up but the same
+for many harvest objects, e.g. licences and publisher abbreviations.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+
+class LRUCache(object):
+    """
+    A bounded, thread-safe, least-recently-used cache that counts its hits
+    and misses.
+
+        cache = LRUCache(maxsize=100)
+        value = cache.get(('licence', rights), lookup_licence, rights)
+    """
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, func, *args):
+        """
+        Returns the value cached for key, or calls func(*args), caches the
+        result against key and returns it.
+        """
+        with self._lock:
+            if key in self._data:
+                # move to the most recently used end
+                value = self._data.pop(key)
+                self._data[key] = value
+                self.hits += 1
+                return value
+            self.misses += 1
+        # not under the lock, since it may be slow or reentrant
+        value = func(*args)
+        with self._lock:
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return value
+
+    def invalidate(self, key=None):
+        """
+        Removes key from the cache, or everything if no key is given.
+        """
+        with self._lock:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = self.misses = 0
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return '<LRUCache size=%s/%s hits=%s misses=%s>' % (
+            len(self._data), self.maxsize, self.hits, self.misses)
+
+
+class TTLCache(LRUCache):
+    """
+    An LRUCache whose values expire ttl seconds after they were cached.
+    """
+
+    def __init__(self, maxsize=1000, ttl=300):
+        super(TTLCache, self).__init__(maxsize)
+        self.ttl = ttl
+
+    def get(self, key, func, *args):
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] <= now:
+                # expired, so recompute it below, counted as a miss
+                del self._data[key]
+        expires, value = super(TTLCache, self).get(
+            key, lambda: (now + self.ttl, func(*args)))
+        return value
+
+
+class JobScopedCache(LRUCache):
+    """
+    An LRUCache which is emptied whenever it is used for a different harvest
+    job, so that nothing looked up is kept beyond the job it was for.
+    """
+
+    def __init__(self, maxsize=1000):
+        super(JobScopedCache, self).__init__(maxsize)
+        self.job_id = None
+
+    def for_job(self, job_id):
+        """
+        Returns the cache, having emptied it if it was last used for another
+        job.
+        """
+        if job_id != self.job_id:
+            if self.job_id is not None:
+                log.info('Lookup cache for job %s: %s hits, %s misses',
+                         self.job_id, self.hits, self.misses)
+            self.invalidate()
+            self.reset_stats()
+            self.job_id = job_id
+        return self
@@ -0,0 +1,153 @@
+"""
+Conditional fetching of inventory documents.
+
+Most inventories are unchanged from one night's harvest to the next, so the
+ETag, Last-Modified and a checksum of the body from the last successful
+harvest of each source are stored on disk. The next fetch sends
+If-None-Match/If-Modified-Since and if the server replies 304 Not Modified, or
+the body's checksum matches, the gather can stop without parsing anything.
+
+Bodies are streamed to a size-capped temporary file rather than read into
+memory, so that the parser can read the document from there.
+"""
+import logging
+import os
+import json
+import hashlib
+import tempfile
+
+import requests
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'dgulocal_fetch_cache')
+# Downloads are refused beyond this size (bytes)
+DEFAULT_MAX_SIZE = 200 * 1024 * 1024
+# Downloads are held in memory up to this size, then spooled to disk
+DEFAULT_SPOOL_SIZE = 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+
+class FetchCache(object):
+    """
+    Stores a small JSON entry per harvest source describing the response of
+    its last successful harvest: url, etag, last_modified and checksum.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR):
+        self.cache_dir = cache_dir
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    @classmethod
+    def from_config(cls):
+        from pylons import config
+        return cls(config.get('ckanext.dgulocal.fetch_cache_dir',
+                              DEFAULT_CACHE_DIR))
+
+    def _path(self, source_id):
+        return os.path.join(self.cache_dir, '%s.json' % source_id)
+
+    def get(self, source_id, url):
+        """
+        Returns the entry for the source, or {} if there is none or it was
+        for a different URL.
+        """
+        try:
+            with open(self._path(source_id), 'r') as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        if entry.get('url') != url:
+            return {}
+        return entry
+
+    def set(self, source_id, entry):
+        # write then rename, so a crash never leaves a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entry, f)
+        os.rename(tmp_path, self._path(source_id))
+
+    def clear(self, source_id):
+        try:
+            os.remove(self._path(source_id))
+        except OSError:
+            pass
+
+
+class DownloadTooLarge(requests.exceptions.RequestException):
+    pass
+
+
+def conditional_get(url, entry, session=requests,
+                    max_size=DEFAULT_MAX_SIZE, spool_size=DEFAULT_SPOOL_SIZE):
+    """
+    GETs the url, sending the validators from a FetchCache entry.
+
+    The body is streamed, gzip/deflate decoded, into a temporary file which
+    is held in memory only up to spool_size bytes. If it grows beyond
+    max_size, DownloadTooLarge is raised.
+
+    Returns (body, new_entry, unchanged). body is the temporary file, at
+    position 0, which the caller should close. unchanged is True if the
+    server replied 304 Not Modified or the body has the same checksum as
+    before, in which case body is None. May raise
+    requests.exceptions.RequestException.
+    """
+    headers = {'Accept-Encoding': 'gzip, deflate'}
+    if entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+
+    response = session.get(url, headers=headers, stream=True)
+    try:
+        response.raise_for_status()
+        if response.status_code == 304:
+            log.debug('Not modified: %s', url)
+            return None, entry, True
+        body, size, checksum = _download(response, max_size, spool_size)
+    finally:
+        response.close()
+
+    new_entry = {'url': url,
+                 'etag': response.headers.get('ETag'),
+                 'last_modified': response.headers.get('Last-Modified'),
+                 'checksum': checksum,
+                 'size': size}
+    if checksum == entry.get('checksum'):
+        log.debug('Content unchanged: %s', url)
+        body.close()
+        return None, new_entry, True
+    return body, new_entry, False
+
+
+def _download(response, max_size, spool_size):
+    """
+    Streams the response's (decoded) body into a SpooledTemporaryFile.
+    Returns (file, size, sha1 checksum).
+    """
+    # Content-Length is the encoded size, so this only rules out the
+    # obviously too large - the decoded size is checked as it is read
+    content_length = response.headers.get('Content-Length')
+    if content_length and content_length.isdigit() and \
+            int(content_length) > max_size:
+        raise DownloadTooLarge('Content-Length %s exceeds maximum of %s bytes'
+                               % (content_length, max_size))
+    body = tempfile.SpooledTemporaryFile(max_size=spool_size)
+    sha1 = hashlib.sha1()
+    size = 0
+    try:
+        for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+            size += len(chunk)
+            if size > max_size:
+                raise DownloadTooLarge('Download exceeds maximum of %s bytes'
+                                       % max_size)
+            sha1.update(chunk)
+            body.write(chunk)
+    except:
+        body.close()
+        raise
+    body.seek(0)
+    return body, size, sha1.hexdigest()
@@ -4,16 +4,44 @@ with a local authority url on statistics.data.gov.uk
 
 e.g.
     http://statistics.data.gov.uk/doc/statistical-geography/E06000031
+
+Boundaries rarely change, so get_cached_boundary serves them from a
+persistent file store instead, keyed by GSS URI, and only refreshes them in
+the background (or via "paster dgulocal refresh-boundaries").
 """
 import logging
 import json
+import os
+import time
+import hashlib
+import tempfile
+import threading
+import warnings
 
+import numpy
 import requests
 from shapely.geometry import Polygon
+from shapely import wkt
 
 
 log = logging.getLogger(__name__)
 
+DEFAULT_CACHE_DIR = os.path.join(tempfile.gettempdir(),
+                                 'dgulocal_boundary_cache')
+# Cached boundaries older than this (seconds) are refreshed
+DEFAULT_TTL = 30 * 24 * 60 * 60
+
+# Simplified variants of each boundary stored alongside the original, as
+# (name, tolerance), from finest to coarsest. The tolerance is in the units of
+# the database SRID, i.e. degrees for WGS 84 (0.001 degrees is about 100m).
+RESOLUTIONS = (
+    ('fine', 0.0001),
+    ('medium', 0.001),
+    ('coarse', 0.01),
+    )
+FULL_RESOLUTION = 'full'
+
+
 def get_boundary(url):
     """
     Gets the geographic boundary from the specified URL which is described for
@@ -25,6 +53,18 @@ def get_boundary(url):
     publisher URI or the GSS URI, so we'll support both.
 
     It returns the Polygon. On error, it will log the error and return None.
+    This always makes live requests - see get_cached_boundary.
+    """
+    gss_url = resolve_gss_url(url)
+    if not gss_url:
+        return None
+    return fetch_boundary(gss_url)
+
+
+def resolve_gss_url(url):
+    """
+    Returns the URL of the GSS JSON for the publisher or GSS URI, looking up
+    the publisher if needed. On error, it will log the error and return None.
     """
     if not 'statistical-geography' in url:
         # e.g.: http://opendatacommunities.org/doc/london-borough-council/redbridge
@@ -49,7 +89,14 @@ def get_boundary(url):
             return None
     else:
         gss_url = url + '.json'
+    return gss_url
+
 
+def fetch_boundary(gss_url):
+    """
+    Fetches the boundary Polygon from the GSS JSON URL. On error, it will log
+    the error and return None.
+    """
     log.debug('Getting Geo boundary for authority: %s', gss_url)
 
     try:
@@ -70,11 +117,208 @@ def get_boundary(url):
         log.error('Key not found (gss): %s', gss_url)
         return None
 
-    def chunk(l):
-        for i in xrange(0, len(l), 2):
-            lat = l[i:i+1][0]
-            lng = l[i+1:i+2][0]
-            yield (float(lat), float(lng))
+    try:
+        return Polygon(parse_coordinates(boundary))
+    except ValueError as e:
+        log.error('Bad boundary coordinates (gss): %s %s', e, gss_url)
+        return None
+
+
+def parse_coordinates(coordinates):
+    """
+    Parses a string of space-separated coordinates, as given in
+    hasExteriorLatLongPolygon, into an (N, 2) array of floats. Shapely builds
+    a Polygon from the array directly, which for coastal authorities with
+    hundreds of thousands of vertices is much quicker than from a list of
+    tuples.
+
+    Raises ValueError if a coordinate is not a number or there is an odd
+    number of them.
+    """
+    if isinstance(coordinates, unicode):
+        coordinates = coordinates.encode('ascii')
+    # parsed in one pass, without a list of strings, but it silently stops at
+    # anything that is not a number
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', DeprecationWarning)
+        values = numpy.fromstring(coordinates, sep=' ')
+    if values.size != _count_tokens(coordinates):
+        tokens = coordinates.split()
+        raise ValueError('Not a number: %r' % tokens[min(values.size,
+                                                         len(tokens) - 1)])
+    if values.size % 2:
+        raise ValueError('Odd number of coordinates: %s' % values.size)
+    if not numpy.isfinite(values).all():
+        raise ValueError('Coordinates include NaN or infinity')
+    return values.reshape(-1, 2)
+
+
+def _count_tokens(string):
+    """
+    Returns the number of whitespace-separated tokens in the string, without
+    splitting it.
+    """
+    if not string:
+        return 0
+    not_space = numpy.frombuffer(string, dtype=numpy.uint8) > 32
+    # each token starts with a non-space after a space, or at the start
+    return int(numpy.count_nonzero(not_space[1:] & ~not_space[:-1]) +
+               not_space[0])
+
+
+def simplified_geometries(shape):
+    """
+    Returns a dict of resolution name: the shape simplified to that
+    resolution's tolerance, for each of RESOLUTIONS. Topology is preserved, so
+    a simplified boundary is never invalid or empty.
+    """
+    return dict((name, shape.simplify(tolerance, preserve_topology=True))
+                for name, tolerance in RESOLUTIONS)
+
+
+def resolution_for_tolerance(tolerance):
+    """
+    Returns the name of the coarsest resolution whose simplification error is
+    no more than the given tolerance, e.g. the pixel size of the map being
+    drawn. FULL_RESOLUTION is returned if none are accurate enough.
+    """
+    best = FULL_RESOLUTION
+    for name, resolution_tolerance in RESOLUTIONS:
+        if resolution_tolerance <= tolerance:
+            best = name
+    return best
+
+
+class BoundaryCache(object):
+    """
+    Persistent file store of authority boundaries.
+
+    Boundaries are stored as WKT keyed by their GSS JSON URL, with the time
+    they were fetched. The publisher URI to GSS URL lookups are stored too,
+    so a cached boundary can be found for either kind of URL without any
+    requests.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, ttl=DEFAULT_TTL):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        for kind in ('gss', 'url'):
+            path = os.path.join(cache_dir, kind)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+    @classmethod
+    def from_config(cls):
+        from pylons import config
+        return cls(config.get('ckanext.dgulocal.boundary_cache_dir',
+                              DEFAULT_CACHE_DIR),
+                   int(config.get('ckanext.dgulocal.boundary_ttl',
+                                  DEFAULT_TTL)))
+
+    def _path(self, kind, key):
+        digest = hashlib.sha1(key.encode('utf8')).hexdigest()
+        return os.path.join(self.cache_dir, kind, digest + '.json')
+
+    def _read(self, kind, key):
+        try:
+            with open(self._path(kind, key), 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _write(self, kind, key, entry):
+        # write then rename, so readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self.cache_dir, kind))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entry, f)
+        os.rename(tmp_path, self._path(kind, key))
+
+    def get(self, url):
+        """
+        Returns (polygon, fresh) for the publisher or GSS URL, or
+        (None, False) if it is not cached.
+        """
+        alias = self._read('url', url)
+        if not alias:
+            return None, False
+        entry = self._read('gss', alias['gss_url'])
+        if not entry:
+            return None, False
+        fresh = time.time() - entry['fetched'] < self.ttl
+        return wkt.loads(entry['wkt']), fresh
+
+    def set(self, url, gss_url, polygon):
+        self._write('gss', gss_url, {'gss_url': gss_url,
+                                     'fetched': time.time(),
+                                     'wkt': polygon.wkt})
+        self._write('url', url, {'url': url, 'gss_url': gss_url})
+
+    def urls(self):
+        """
+        Yields each URL that a boundary has been cached for.
+        """
+        url_dir = os.path.join(self.cache_dir, 'url')
+        for filename in os.listdir(url_dir):
+            try:
+                with open(os.path.join(url_dir, filename), 'r') as f:
+                    yield json.load(f)['url']
+            except (IOError, ValueError, KeyError):
+                continue
+
+
+def refresh_boundary(url, cache):
+    """
+    Fetches the boundary for the publisher or GSS URL live and stores it in
+    the cache. Returns the Polygon, or None on error (leaving any cached
+    boundary in place).
+    """
+    gss_url = resolve_gss_url(url)
+    if not gss_url:
+        return None
+    polygon = fetch_boundary(gss_url)
+    if polygon is not None:
+        cache.set(url, gss_url, polygon)
+    return polygon
+
+
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+
+def _refresh_in_background(url, cache):
+    with _refreshing_lock:
+        if url in _refreshing:
+            return
+        _refreshing.add(url)
 
-    poly = Polygon([c for c in chunk(boundary.strip().split(' '))])
-    return poly
+    def refresh():
+        try:
+            refresh_boundary(url, cache)
+        except Exception, e:
+            log.exception('Failed to refresh boundary %s: %s', url, e)
+        finally:
+            with _refreshing_lock:
+                _refreshing.discard(url)
+
+    thread = threading.Thread(target=refresh)
+    thread.setDaemon(True)
+    thread.start()
+
+
+def get_cached_boundary(url, cache=None):
+    """
+    Returns the boundary Polygon for the publisher or GSS URL from the
+    cache, without waiting on any requests.
+
+    If the cached boundary is older than the cache's TTL it is still
+    returned, and refreshed in the background (stale-while-revalidate). If
+    it is not cached at all, None is returned and it is fetched in the
+    background, ready for next time.
+    """
+    cache = cache or BoundaryCache.from_config()
+    polygon, fresh = cache.get(url)
+    if not fresh:
+        log.debug('Boundary %s, refreshing: %s',
+                  'stale' if polygon else 'not cached', url)
+        _refresh_in_background(url, cache)
+    return polygon
@@ -0,0 +1,29 @@
+"""
+Template helpers for the dgu_local plugin.
+"""
+from ckanext.dgulocal.lib.services import label_table
+
+
+def esd_label(uri, default=None):
+    '''
+    Returns the label of the ESD function or service URI, e.g.
+    http://id.esd.org.uk/service/190 -> "Benefits advice and assessment",
+    or default (the URI itself if not given) if it is not known.
+    '''
+    return label_table().get(uri, uri if default is None else default)
+
+
+def esd_facet_items(items):
+    '''
+    Returns the (facet_key, item) pairs, as given by
+    h.search_facets_unselected/selected, with the display_name of each
+    service or function item set to its label.
+    '''
+    labels = label_table()
+    labelled = []
+    for facet_key, item in items:
+        label = labels.get(item.get('name', ''))
+        if label:
+            item = dict(item, display_name=label)
+        labelled.append((facet_key, item))
+    return labelled
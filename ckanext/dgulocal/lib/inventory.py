@@ -3,6 +3,9 @@ import cStringIO
 import os
 import HTMLParser
 import datetime
+import hashlib
+import json
+import threading
 
 import lxml.etree
 
@@ -10,58 +13,191 @@ log = logging.getLogger(__name__)
 
 NSMAP = {'inv': 'http://schemas.esd.org.uk/inventory'}
 
+INV = '{%s}' % NSMAP['inv']
+
+# Child elements of inv:Dataset and inv:Rendition, and the keys they are
+# extracted to by dataset_to_dict and resource_to_dict
+DATASET_FIELDS = {
+    INV + 'Identifier': 'identifier',
+    INV + 'Title': 'title',
+    INV + 'Description': 'description',
+    INV + 'Rights': 'rights',
+    }
+SUBJECT_FIELDS = {
+    INV + 'Service': 'service',
+    INV + 'Function': 'function',
+    }
+RENDITION_FIELDS = {
+    INV + 'Identifier': 'url',
+    INV + 'Title': 'title',
+    INV + 'Description': 'description',
+    INV + 'MimeType': 'mimetype',
+    INV + 'Availability': 'availability',
+    INV + 'ConformsTo': 'conforms_to',
+    }
+SUBJECTS_TAG = INV + 'Subjects'
+SUBJECT_TAG = INV + 'Subject'
+RESOURCES_TAG = INV + 'Resources'
+RESOURCE_TAG = INV + 'Resource'
+RENDITIONS_TAG = INV + 'Renditions'
+RENDITION_TAG = INV + 'Rendition'
+
+# Compiled once, rather than on every call to node.xpath()
+DATASET_NODES_XPATH = lxml.etree.XPath(
+    '/inv:Inventory/inv:Datasets/inv:Dataset', namespaces=NSMAP)
+METADATA_XPATHS = [
+    (key, lxml.etree.XPath(path, namespaces=NSMAP)) for key, path in (
+        ('identifier', 'inv:Identifier'),
+        ('title', 'inv:Metadata/inv:Title'),
+        ('publisher', 'inv:Metadata/inv:Publisher'),
+        ('description', 'inv:Metadata/inv:Description'),
+        ('spatial-coverage-url', 'inv:Metadata/inv:Coverage/inv:Spatial'),
+        )]
+
+_html_parser = HTMLParser.HTMLParser()
+
+# Version of the record format written by InventoryDocument.serialize_record.
+# Bump it when the dict from dataset_to_dict changes, so that records from
+# older harvests are re-extracted from their XML.
+RECORD_VERSION = 1
+
+DATA_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "../data"))
+DEFAULT_SCHEMA_VERSION = 'default'
+
 
 class InventoryXmlError(Exception):
     pass
 
 
+class SchemaRegistry(object):
+    """
+    Process-wide cache of compiled Inventory XSD schemas, keyed by version.
+
+    Each schema is compiled once and only recompiled if the XSD file's mtime
+    changes. Compiled XMLSchema objects are shared, but lxml parsers must not
+    be shared between threads, so each thread gets its own parser per schema.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._paths = {}
+        # version: (mtime, XMLSchema)
+        self._schemas = {}
+        self._local = threading.local()
+
+    def register(self, version, path):
+        """
+        Registers the XSD file at path as the given schema version. It is
+        compiled lazily, on first use.
+        """
+        with self._lock:
+            self._paths[version] = path
+            self._schemas.pop(version, None)
+
+    def versions(self):
+        return sorted(self._paths.keys())
+
+    def _compile(self, version):
+        """
+        Returns (mtime, XMLSchema) for the version, compiling it if it has not
+        been compiled yet or the file has changed since.
+        """
+        try:
+            path = self._paths[version]
+        except KeyError:
+            raise InventoryXmlError('Unknown schema version: %s' % version)
+        mtime = os.path.getmtime(path)
+        cached = self._schemas.get(version)
+        if cached and cached[0] == mtime:
+            return cached
+        with self._lock:
+            cached = self._schemas.get(version)
+            if cached and cached[0] == mtime:
+                return cached
+            log.debug('Compiling inventory schema %s: %s', version, path)
+            cached = (mtime, lxml.etree.XMLSchema(lxml.etree.parse(path)))
+            self._schemas[version] = cached
+            return cached
+
+    def get_schema(self, version=DEFAULT_SCHEMA_VERSION):
+        return self._compile(version)[1]
+
+    def get_parser(self, version=DEFAULT_SCHEMA_VERSION):
+        """
+        Returns an XMLParser that validates against the schema version. The
+        parser belongs to the calling thread.
+        """
+        mtime, schema = self._compile(version)
+        parsers = getattr(self._local, 'parsers', None)
+        if parsers is None:
+            parsers = self._local.parsers = {}
+        cached = parsers.get(version)
+        if cached and cached[0] is schema:
+            return cached[1]
+        parser = lxml.etree.XMLParser(schema=schema)
+        parsers[version] = (schema, parser)
+        return parser
+
+    def clear(self):
+        with self._lock:
+            self._schemas.clear()
+        self._local = threading.local()
+
+
+schema_registry = SchemaRegistry()
+schema_registry.register(DEFAULT_SCHEMA_VERSION,
+                         os.path.join(DATA_DIR, "inventory.xsd"))
+
+
 class InventoryDocument(object):
     """
     Represents an Inventory XML document. It can be validated and parsed to
     extract its content.
     """
 
-    def __init__(self, inventory_xml_string):
+    def __init__(self, inventory_xml_string,
+                 schema_version=DEFAULT_SCHEMA_VERSION):
         """
-        Initialize with an Inventory XML string.
+        Initialize with an Inventory XML string, or a file-like object to read
+        it from (which is left open).
         It validates it against the schema and therefore may raise
         InventoryXmlError
         """
-        # Load the XSD and make sure we use it to validate the incoming
-        # XML
-        schema_content = self._load_schema()
-        schema = lxml.etree.XMLSchema(schema_content)
-        parser = lxml.etree.XMLParser(schema=schema)
+        # Use the compiled XSD from the registry to validate the incoming XML
+        parser = schema_registry.get_parser(schema_version)
 
         # Load and parse the Inventory XML
-        xml_file = cStringIO.StringIO(inventory_xml_string)
+        if hasattr(inventory_xml_string, 'read'):
+            xml_file = inventory_xml_string
+        else:
+            xml_file = cStringIO.StringIO(inventory_xml_string)
         try:
             self.doc = lxml.etree.parse(xml_file, parser=parser)
         except lxml.etree.XMLSyntaxError, e:
             raise InventoryXmlError(unicode(e))
         finally:
-            xml_file.close()
-
-    def _load_schema(self):
-        d = os.path.abspath(os.path.join(os.path.dirname(__file__), "../data"))
-        f = os.path.join(d, "inventory.xsd")
-        return lxml.etree.parse(f)
+            if xml_file is not inventory_xml_string:
+                xml_file.close()
 
     def top_level_metadata(self):
         """
         Extracts the top-level inv:Metadata from the XML document, and returns
         it in a dictionary.
         """
+        return self._root_metadata(self.doc.getroot())
+
+    @classmethod
+    def _root_metadata(cls, root):
+        """
+        Extracts the top-level metadata given the inv:Inventory root node. Only
+        the root's attributes and the nodes before inv:Datasets are needed.
+        """
         md = {}
 
-        root = self.doc.getroot()
         modified_str = root.get('Modified')
         md['modified'] = datetime.datetime.strptime(modified_str, '%Y-%m-%d').date() if modified_str else None
-        md['identifier'] = self._get_node_text(root.xpath('inv:Identifier', namespaces=NSMAP))
-        md['title'] = self._get_node_text(root.xpath('inv:Metadata/inv:Title', namespaces=NSMAP))
-        md['publisher'] = self._get_node_text(root.xpath('inv:Metadata/inv:Publisher', namespaces=NSMAP))
-        md['description'] = self._get_node_text(root.xpath('inv:Metadata/inv:Description', namespaces=NSMAP))
-        md['spatial-coverage-url'] = self._get_node_text(root.xpath('inv:Metadata/inv:Coverage/inv:Spatial', namespaces=NSMAP))
+        for key, xpath in METADATA_XPATHS:
+            md[key] = cls._get_node_text(xpath(root))
 
         return md
 
@@ -69,7 +205,7 @@ class InventoryDocument(object):
         """
         Yields each inv:Dataset within the XML document as a node
         """
-        for node in self.doc.xpath('/inv:Inventory/inv:Datasets/inv:Dataset', namespaces=NSMAP):
+        for node in DATASET_NODES_XPATH(self.doc):
             yield node
 
     @staticmethod
@@ -80,6 +216,57 @@ class InventoryDocument(object):
         # since otherwise it complains when parsing it
         return lxml.etree.tostring(node, inclusive_ns_prefixes=['inv'])
 
+    @classmethod
+    def serialize_record(cls, dataset, node):
+        """
+        Serializes a dataset that has been extracted by dataset_to_dict into a
+        JSON record, together with the original Dataset node's XML. This is
+        what is stored in HarvestObject.content, so that the import stage does
+        not have to parse the XML again.
+        """
+        dataset = dict(dataset)
+        if dataset['modified']:
+            dataset['modified'] = dataset['modified'].isoformat()
+        return json.dumps({'record_version': RECORD_VERSION,
+                           'dataset': dataset,
+                           'xml': cls.serialize_node(node)},
+                          separators=(',', ':'))
+
+    @staticmethod
+    def dataset_digest(dataset):
+        """
+        Returns a stable digest of a dataset extracted by dataset_to_dict,
+        which changes only if its content does. The modified date is left out
+        since some publishers update it on every export.
+        """
+        content = dict((key, value) for key, value in dataset.iteritems()
+                       if key != 'modified')
+        return hashlib.sha1(json.dumps(content, sort_keys=True,
+                                       separators=(',', ':'))).hexdigest()
+
+    @classmethod
+    def record_to_dict(cls, content):
+        """
+        Returns the dataset dict from a record written by serialize_record.
+
+        Content from older harvests, which is just the Dataset node's XML, and
+        records of a different RECORD_VERSION are extracted from the XML.
+        """
+        if content.lstrip().startswith('{'):
+            record = json.loads(content)
+            if record.get('record_version') == RECORD_VERSION:
+                dataset = record['dataset']
+                if dataset['modified']:
+                    dataset['modified'] = datetime.datetime.strptime(
+                        dataset['modified'], '%Y-%m-%d').date()
+                return dataset
+            log.debug('Re-extracting record of version %s',
+                      record.get('record_version'))
+            content = record['xml']
+        if isinstance(content, unicode):
+            content = content.encode('utf8')
+        return cls.dataset_to_dict(cls.parse_xml_string(content))
+
     @staticmethod
     def _get_node_text(node, default=''):
         """
@@ -103,37 +290,44 @@ class InventoryDocument(object):
     @classmethod
     def dataset_to_dict(cls, node):
         """
-        Converts a Dataset node to a dictionary, complete with the resources
+        Converts a Dataset node to a dictionary, complete with the resources.
+
+        The node's children are visited once, and their text is mapped to
+        dict keys by DATASET_FIELDS. As with an xpath lookup, the first
+        matching element wins and missing ones default to ''.
         """
         d = {}
-        d['identifier'] = cls._get_node_text(node.xpath('inv:Identifier',namespaces=NSMAP))
-        d['title'] = cls._get_node_text(node.xpath('inv:Title',namespaces=NSMAP))
+        subjects = {}
+        resources = []
+        for child in node:
+            tag = child.tag
+            if tag in DATASET_FIELDS:
+                key = DATASET_FIELDS[tag]
+                if key not in d:
+                    d[key] = child.text
+            elif tag == SUBJECTS_TAG:
+                for subject in child.iterchildren(SUBJECT_TAG):
+                    cls._extract_fields(subject, SUBJECT_FIELDS, subjects)
+            elif tag == RESOURCES_TAG:
+                for resnode in child.iterchildren(RESOURCE_TAG):
+                    resources.extend(cls.resource_to_dict(resnode))
+        for key in DATASET_FIELDS.itervalues():
+            d.setdefault(key, '')
+
         modified_str = node.get('Modified')
         d['modified'] = datetime.datetime.strptime(modified_str, '%Y-%m-%d').date() if modified_str else None
         d['active'] = node.get('Active') in ['True', 'Yes']
-        d['description'] = cls._get_node_text(node.xpath('inv:Description',namespaces=NSMAP))
-        d['rights'] = cls._get_node_text(node.xpath('inv:Rights',namespaces=NSMAP))
         if d['rights'] == 'http://www.nationalarchives.gov.uk/doc/open-government-licence':
             d['rights'] = 'http://www.nationalarchives.gov.uk/doc/open-government-licence/version/2/'
 
         # Clean description to decode any encoded HTML
-        h = HTMLParser.HTMLParser()
-        d['description'] = h.unescape(d.get('description', ''))
-
-        services = []
-        functions = []
-        svc = cls._get_node_text(node.xpath('inv:Subjects/inv:Subject/inv:Service', namespaces=NSMAP))
-        fn = cls._get_node_text(node.xpath('inv:Subjects/inv:Subject/inv:Function', namespaces=NSMAP))
-        if svc:
-            services.append(svc)
-        if fn:
-            functions.append(fn)
-
-        d['services'] = services
-        d['functions'] = functions
-        d['resources'] = []
-        for resnode in node.xpath('inv:Resources/inv:Resource', namespaces=NSMAP):
-            d['resources'].extend(cls.resource_to_dict(resnode))
+        d['description'] = _html_parser.unescape(d['description'])
+
+        svc = subjects.get('service')
+        fn = subjects.get('function')
+        d['services'] = [svc] if svc else []
+        d['functions'] = [fn] if fn else []
+        d['resources'] = resources
         return d
 
     @classmethod
@@ -142,17 +336,92 @@ class InventoryDocument(object):
         When passed an inv:Resource node this method will flatten down all of the
         inv:Renditions into CKAN resources.
         """
+        for renditions in node.iterchildren(RENDITIONS_TAG):
+            for n in renditions.iterchildren(RENDITION_TAG):
+                res = {}
+                cls._extract_fields(n, RENDITION_FIELDS, res)
+                for key in RENDITION_FIELDS.itervalues():
+                    res.setdefault(key, '')
+                # If no active flag, default to active.
+                res['active'] = n.get('Active') in ['Yes', 'True', '', None]
+                res['resource_type'] = n.get('Type')
+                yield res
 
-        res = {}
-        for n in node.xpath('inv:Renditions/inv:Rendition', namespaces=NSMAP):
-            res['url'] = cls._get_node_text(n.xpath('inv:Identifier', namespaces=NSMAP))
-            # If no active flag, default to active.
-            res['active'] = n.get('Active') in ['Yes', 'True', '', None]
-            res['resource_type'] = n.get('Type')
-            res['title'] = cls._get_node_text(n.xpath('inv:Title', namespaces=NSMAP))
-            res['description'] = cls._get_node_text(n.xpath('inv:Description', namespaces=NSMAP))
-            res['mimetype'] = cls._get_node_text(n.xpath('inv:MimeType', namespaces=NSMAP))
-            res['availability'] = cls._get_node_text(n.xpath('inv:Availability', namespaces=NSMAP))
-            res['conforms_to'] = cls._get_node_text(n.xpath('inv:ConformsTo', namespaces=NSMAP))
-            yield res
+    @staticmethod
+    def _extract_fields(node, fields, d):
+        """
+        Copies the text of node's children into d, using the fields mapping
+        of tag to key. Keys already in d are left alone, so the first element
+        found wins.
+        """
+        for child in node:
+            key = fields.get(child.tag)
+            if key and key not in d:
+                d[key] = child.text
+
+
+class InventoryStream(object):
+    """
+    Streaming alternative to InventoryDocument for very large Inventory
+    documents. The XML is parsed incrementally with iterparse and each
+    inv:Dataset is cleared once the caller has finished with it, so memory use
+    stays roughly flat however many datasets the document has.
 
+    Validation happens as the document is read, so InventoryXmlError may be
+    raised part-way through dataset_nodes(). Each stream can be iterated once.
+    """
+    DATASETS_TAG = INV + 'Datasets'
+    DATASET_TAG = INV + 'Dataset'
+
+    def __init__(self, source, schema_version=DEFAULT_SCHEMA_VERSION):
+        """
+        Initialize with a filename or file-like object containing the
+        Inventory XML. Nothing is read until it is asked for.
+        """
+        self._events = self._parse(
+            source, schema_registry.get_schema(schema_version))
+        self._root = None
+        self._metadata = None
+
+    @staticmethod
+    def _parse(source, schema):
+        try:
+            for event, node in lxml.etree.iterparse(
+                    source, events=('start', 'end'), schema=schema):
+                yield event, node
+        except lxml.etree.XMLSyntaxError, e:
+            raise InventoryXmlError(unicode(e))
+
+    def top_level_metadata(self):
+        """
+        Returns the top-level metadata, in the same form as
+        InventoryDocument.top_level_metadata. It is available without reading
+        any datasets since it comes before inv:Datasets in the document.
+        """
+        if self._metadata is None:
+            for event, node in self._events:
+                if self._root is None:
+                    self._root = node
+                if event == 'start' and node.tag == self.DATASETS_TAG:
+                    break
+            if self._root is None:
+                raise InventoryXmlError('Empty inventory document')
+            self._metadata = InventoryDocument._root_metadata(self._root)
+        return self._metadata
+
+    def dataset_nodes(self):
+        """
+        Yields each inv:Dataset within the XML document as a node. The node
+        is cleared once the next one is requested, so take what you need from
+        it (e.g. with dataset_to_dict or serialize_node) before moving on.
+        """
+        self.top_level_metadata()
+        for event, node in self._events:
+            if event != 'end' or node.tag != self.DATASET_TAG:
+                continue
+            yield node
+            # Free the dataset and any earlier siblings still referenced by
+            # the parent
+            node.clear()
+            while node.getprevious() is not None:
+                del node.getparent()[0]
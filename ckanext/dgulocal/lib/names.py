@@ -0,0 +1,167 @@
+"""
+Reservation of names for new packages created by a harvest job.
+
+Rather than testing candidate names against the database one at a time, the
+existing names starting with a slug are loaded in one query, the first time
+that slug is seen in the job, and unique names are then handed out from
+memory. Each name handed out is also recorded in the
+dgulocal_name_reservation table, whose primary key stops concurrent jobs (or
+parallel import workers) from claiming the same name before either has
+created its package, so the table must exist ("paster dgulocal init").
+"""
+import logging
+import datetime
+
+from sqlalchemy import types, Column, Table, select
+from sqlalchemy.exc import IntegrityError
+
+from ckan.model import meta
+
+log = logging.getLogger(__name__)
+
+PACKAGE_NAME_MAX_LENGTH = 100
+# The existing names loaded for a slug are those starting with all but this
+# many characters of it, so that they include the candidates that are
+# truncated to make room for a counter
+MAX_COUNTER_LENGTH = 4
+# Reservations are only needed until the package is created
+RESERVATION_EXPIRY = datetime.timedelta(days=1)
+
+name_reservation_table = Table(
+    'dgulocal_name_reservation', meta.metadata,
+    Column('name', types.UnicodeText, primary_key=True),
+    Column('job_id', types.UnicodeText),
+    Column('created', types.DateTime, default=datetime.datetime.utcnow),
+    )
+
+
+class NameReservations(object):
+    """
+    Hands out unique package names for one harvest job at a time.
+
+        names = NameReservations().for_job(job_id)
+        name = names.reserve('Payments over 500 PCC')
+    """
+
+    def __init__(self):
+        self.job_id = None
+        # slug: set of names taken, in the db or reserved by this job
+        self._taken = {}
+        self._table_exists = None
+
+    def for_job(self, job_id):
+        """
+        Returns the reservations, having forgotten those of any other job.
+        """
+        if job_id != self.job_id:
+            self._taken = {}
+            self.job_id = job_id
+        return self
+
+    def reserve(self, title):
+        """
+        Returns a name based on the title that no other package has and that
+        has not been reserved by this or a concurrent job.
+        """
+        slug = self._slug(title)
+        taken = self._taken.get(slug)
+        if taken is None:
+            taken = self._taken[slug] = self._load_taken(slug)
+        counter = 0
+        while True:
+            suffix = str(counter) if counter else ''
+            candidate = slug[:PACKAGE_NAME_MAX_LENGTH - len(suffix)] + suffix
+            counter += 1
+            if candidate in taken:
+                continue
+            taken.add(candidate)
+            if len(suffix) > MAX_COUNTER_LENGTH and \
+                    self._package_exists(candidate):
+                # not covered by the names loaded for the slug
+                continue
+            if self._record(candidate):
+                return candidate
+
+    @staticmethod
+    def _slug(title):
+        # as HarvesterBase._gen_new_name does
+        from ckan.lib.munge import munge_title_to_name
+        slug = munge_title_to_name(title).replace('_', '-')
+        while '--' in slug:
+            slug = slug.replace('--', '-')
+        return slug
+
+    def _load_taken(self, slug):
+        """
+        Returns the set of existing package names, and names reserved by other
+        jobs, that could be candidates for the slug - those starting with it,
+        less the characters that a long slug loses to the counter.
+        """
+        from ckan import model
+
+        self._check_table()
+        like = u'%s%%' % slug[:PACKAGE_NAME_MAX_LENGTH - MAX_COUNTER_LENGTH]
+        taken = set(name for name, in model.Session.query(model.Package.name)
+                                           .filter(model.Package.name.like(like)))
+        taken.update(
+            name for name, in meta.engine.execute(
+                select([name_reservation_table.c.name])
+                .where(name_reservation_table.c.name.like(like))))
+        return taken
+
+    @staticmethod
+    def _package_exists(name):
+        from ckan import model
+        return model.Session.query(model.Package.id)\
+                    .filter(model.Package.name==name).first() is not None
+
+    def _record(self, name):
+        """
+        Records the reservation of the name. Returns False if a concurrent
+        job has reserved it first.
+        """
+        self._check_table()
+        try:
+            # on its own connection, so that it is committed straight away
+            meta.engine.execute(name_reservation_table.insert(),
+                                name=name, job_id=self.job_id,
+                                created=datetime.datetime.utcnow())
+        except IntegrityError:
+            log.debug('Name reserved by a concurrent job: %s', name)
+            return False
+        return True
+
+    def _check_table(self):
+        if not self._table_exists:
+            check_name_reservation_table(meta.engine)
+            self._table_exists = True
+            expire_reservations()
+
+
+def check_name_reservation_table(engine):
+    """
+    Raises an exception if the name reservation table does not exist, since
+    without it concurrent jobs and parallel import workers could generate
+    the same package names.
+    """
+    if not name_reservation_table.exists(bind=engine):
+        raise Exception('Generating package names needs the %s table, so '
+                        'that concurrent harvests and parallel import workers '
+                        'do not generate the same one. Run "paster dgulocal '
+                        'init" to create it.' % name_reservation_table.name)
+
+
+def expire_reservations():
+    """
+    Deletes reservations older than RESERVATION_EXPIRY, by which time their
+    packages will have been created (or not).
+    """
+    meta.engine.execute(name_reservation_table.delete().where(
+        name_reservation_table.c.created <
+        datetime.datetime.utcnow() - RESERVATION_EXPIRY))
+
+
+def init_name_reservation_table(engine):
+    if not name_reservation_table.exists(bind=engine):
+        name_reservation_table.create(bind=engine)
+        log.debug('%s table created in the db', name_reservation_table.name)
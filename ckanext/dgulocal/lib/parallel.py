@@ -0,0 +1,116 @@
+"""
+Opt-in parallel import stage for inventory harvest jobs.
+
+Normally the harvest fetch queue consumer imports a job's objects one at a
+time. import_job() instead spreads them over a pool of worker processes. Each
+worker disposes of the database connections inherited from the parent, so it
+has its own connections and SQLAlchemy session. Generated package names are
+reserved in the dgulocal_name_reservation table (see lib/names.py), so two
+workers cannot give new packages the same name before either has committed.
+"""
+import logging
+import datetime
+import multiprocessing
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PROCESSES = 4
+
+# The InventoryHarvester of a worker process
+_harvester = None
+
+
+def import_job(job_id, processes=DEFAULT_PROCESSES):
+    """
+    Fetches and imports the job's waiting objects using a pool of worker
+    processes.
+
+    Returns a dict of the count of objects for each resulting state.
+    """
+    from ckan import model
+    from ckanext.harvest.model import HarvestObject
+    from ckanext.dgulocal.lib.names import check_name_reservation_table
+
+    check_name_reservation_table(model.meta.engine)
+
+    object_ids = [object_id for object_id, in
+                  model.Session.query(HarvestObject.id)
+                       .filter(HarvestObject.harvest_job_id==job_id)
+                       .filter(HarvestObject.state==u'WAITING')]
+    model.Session.remove()
+    # Close the parent's connections, so that the forked workers don't
+    # inherit (and share) them
+    model.meta.engine.dispose()
+    log.info('Importing %s objects of job %s with %s processes',
+             len(object_ids), job_id, processes)
+
+    pool = multiprocessing.Pool(processes, initializer=_init_worker)
+    counts = {}
+    try:
+        for object_id, state in pool.imap_unordered(_import_object,
+                                                    object_ids):
+            counts[state] = counts.get(state, 0) + 1
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return counts
+
+
+def _init_worker():
+    global _harvester
+    from ckan import model
+    from ckanext.dgulocal.harvester import InventoryHarvester
+
+    # In case any connections were opened after the parent disposed of them
+    model.meta.engine.dispose()
+    model.Session.remove()
+    _harvester = InventoryHarvester()
+
+
+def _import_object(object_id):
+    """
+    Fetches and imports a single object, as the harvest fetch queue consumer
+    does, and returns (object_id, resulting state). Runs in a worker.
+    """
+    from ckan import model
+    from ckanext.harvest.model import HarvestObject
+
+    claimed = False
+    try:
+        # Claim the object, in case something else is importing the job too
+        claimed = model.Session.query(HarvestObject)\
+            .filter(HarvestObject.id==object_id)\
+            .filter(HarvestObject.state==u'WAITING')\
+            .update({'state': u'FETCH',
+                     'fetch_started': datetime.datetime.utcnow()},
+                    synchronize_session=False)
+        model.Session.commit()
+        if not claimed:
+            return object_id, 'SKIPPED'
+
+        obj = HarvestObject.get(object_id)
+        success = _harvester.fetch_stage(obj)
+        obj.fetch_finished = datetime.datetime.utcnow()
+        if success:
+            obj.state = u'IMPORT'
+            obj.import_started = datetime.datetime.utcnow()
+            obj.save()
+            success = _harvester.import_stage(obj)
+            obj.import_finished = datetime.datetime.utcnow()
+        obj.state = u'COMPLETE' if success else u'ERROR'
+        obj.save()
+        return object_id, obj.state
+    except Exception, e:
+        log.exception('Import failed for object %s: %s', object_id, e)
+        model.Session.rollback()
+        if claimed:
+            model.Session.query(HarvestObject)\
+                .filter(HarvestObject.id==object_id)\
+                .update({'state': u'ERROR'}, synchronize_session=False)
+            model.Session.commit()
+        return object_id, u'ERROR'
+    finally:
+        model.Session.remove()
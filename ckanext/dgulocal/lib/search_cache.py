@@ -0,0 +1,122 @@
+"""
+Cache of the rendered /local search pages.
+
+Most hits on /local are anonymous and for the same few searches, starting
+with the landing page with no filters, so LocalController.search caches the
+pages it renders for anonymous users for a few minutes, keyed by the
+normalized request parameters. Logged-in users may see private datasets, so
+their searches are not cached.
+
+Web workers can't be told directly when a harvest changes the datasets, so
+whenever the inventory harvester creates, updates or deletes a package, it
+touches a stamp file (invalidate_search_cache) and each worker empties its
+cache when it sees the file's mtime change.
+"""
+import os
+import re
+import json
+import logging
+import tempfile
+import threading
+
+from ckanext.dgulocal.lib.cache import TTLCache
+from ckanext.dgulocal.lib.stamp import ChangeStamp
+
+log = logging.getLogger(__name__)
+
+DEFAULT_TTL = 5 * 60
+DEFAULT_MAX_SIZE = 500
+DEFAULT_STAMP_FILE = os.path.join(tempfile.gettempdir(),
+                                  'dgulocal_search_cache.stamp')
+
+# A plain filter query clause, e.g. service:"http://id.esd.org.uk/service/190"
+FQ_CLAUSE = re.compile(r'^[\w.-]+:"(?:[^"\\]|\\.)*"$')
+FQ_TOKEN = re.compile(r'\S+:"(?:[^"\\]|\\.)*"|\S+')
+
+
+def normalize_fq(fq):
+    """
+    Returns the filter query with its clauses sorted, if every clause is a
+    plain field:"value" (so they are all ANDed), or else unchanged, since
+    reordering OR, NOT or parentheses could change what it means.
+    """
+    clauses = FQ_TOKEN.findall(fq)
+    if all(FQ_CLAUSE.match(clause) for clause in clauses):
+        return ' '.join(sorted(clauses))
+    return fq
+
+
+def normalize_search(params):
+    """
+    Returns the cache key for a search's (name, value) request parameters.
+    The parameters are sorted (facet filters are ANDed, so their order
+    doesn't matter) and the query stripped, so that the same search with its
+    filters applied in a different order gets the same page.
+    """
+    normalized = []
+    for name, value in params:
+        if name == 'q':
+            value = value.strip()
+        elif name == 'fq':
+            value = normalize_fq(value)
+        normalized.append((name, value))
+    return json.dumps(sorted(normalized))
+
+
+class SearchCache(TTLCache):
+    """
+    A TTLCache that empties itself when the stamp file is touched.
+    """
+
+    def __init__(self, maxsize=DEFAULT_MAX_SIZE, ttl=DEFAULT_TTL,
+                 stamp_file=DEFAULT_STAMP_FILE):
+        super(SearchCache, self).__init__(maxsize, ttl)
+        self.stamp = ChangeStamp(stamp_file)
+
+    def search(self, params, func, *args):
+        """
+        Returns the cached page for the search parameters, or calls
+        func(*args) and caches what it returns.
+        """
+        if self.stamp.changed():
+            log.info('Search cache invalidated by %s', self.stamp.path)
+            self.invalidate()
+        return self.get(normalize_search(params), func, *args)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hit_rate, 'size': len(self),
+                'max_size': self.maxsize, 'ttl': self.ttl}
+
+
+def _from_config():
+    from pylons import config
+    return SearchCache(
+        int(config.get('ckanext.dgulocal.search_cache_size',
+                       DEFAULT_MAX_SIZE)),
+        int(config.get('ckanext.dgulocal.search_cache_ttl', DEFAULT_TTL)),
+        config.get('ckanext.dgulocal.search_cache_stamp', DEFAULT_STAMP_FILE))
+
+_search_cache = None
+_search_cache_lock = threading.Lock()
+
+
+def search_cache():
+    """
+    Returns this process's SearchCache.
+    """
+    global _search_cache
+    if _search_cache is None:
+        with _search_cache_lock:
+            if _search_cache is None:
+                _search_cache = _from_config()
+    return _search_cache
+
+
+def invalidate_search_cache():
+    """
+    Tells every process's search cache to empty itself, by touching the
+    stamp file.
+    """
+    search_cache().stamp.touch()
+    log.info('Search caches invalidated')
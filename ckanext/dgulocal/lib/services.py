@@ -4,11 +4,20 @@ services and functions list which is hosted at the following URL:
 
   http://standards.esd.org.uk/xml?uri=list/functions&mappedToUri=list/services
 
-At this point, we really don't care so much about the hierarchy, but we do
-probably want to store the labels against the URIs so that we can match them in
-the harvested datasets.
+A copy of the list is bundled as data/functions_services.xml. esd_registry()
+streams it once per process into tables of URI: EsdEntry for the functions
+and services, and saves those as an index file, which later processes load
+instead of parsing the XML again. The live list is only downloaded by an
+explicit refresh_registry() ("paster dgulocal refresh-esd").
 """
+import os
+import json
 import logging
+import tempfile
+import threading
+import bisect
+import collections
+from array import array
 
 import requests
 import cStringIO
@@ -16,17 +25,30 @@ import lxml.etree
 
 log = logging.getLogger(__name__)
 
+ESD_URL = "http://standards.esd.org.uk/xml?uri=list/functions&mappedToUri=list/services"
+BUNDLED_FILE = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                            '../data/functions_services.xml'))
+DEFAULT_INDEX_DIR = os.path.join(tempfile.gettempdir(), 'dgulocal_esd')
+# Increment when the index file format changes
+INDEX_VERSION = 1
+
 INTERESING_TAG_LIST = ['Identifier', 'URI', 'Label', 'Description']
 
+# parent is the URI of the function that the function or service is under
+EsdEntry = collections.namedtuple(
+    'EsdEntry', ['uri', 'identifier', 'label', 'description', 'parent'])
+
+
 def load_services():
     """
     Loads the XML document for the service function list and returns it as a
     dictionary modelling the hierarchy for storing as a JSON blob.
+
+    This always downloads the live list - see esd_registry.
     """
-    url = "http://standards.esd.org.uk/xml?uri=list/functions&mappedToUri=list/services"
     log.debug("Fetching service list content")
 
-    req = requests.get(url)
+    req = requests.get(ESD_URL)
     if not req.ok:
         log.error("Failed to retrieve service list")
         return None
@@ -37,26 +59,311 @@ def load_services():
 def _load_functions_services(raw_data):
     data = cStringIO.StringIO(raw_data)
     try:
-        doc = lxml.etree.parse(data)
-    except Exception, e:
+        registry = EsdRegistry.parse(data)
+    except lxml.etree.XMLSyntaxError, e:
         log.exception(e)
-        data.close()
         return
+    finally:
+        data.close()
+
+    def load_dict(entries):
+        return dict((entry.uri, {'identifier': entry.identifier,
+                                 'uri': entry.uri,
+                                 'label': entry.label,
+                                 'description': entry.description})
+                    for entry in entries.itervalues())
+
+    return {"functions": load_dict(registry.functions),
+            "services": load_dict(registry.services)}
+
+
+class EsdRegistry(object):
+    """
+    The ESD functions and services, as dicts of URI: EsdEntry.
+    """
+
+    def __init__(self, functions, services):
+        self.functions = functions
+        self.services = services
+        self._hierarchy = None
+
+    @property
+    def hierarchy(self):
+        """
+        The EsdHierarchy of the functions and services, built the first time
+        it is needed.
+        """
+        if self._hierarchy is None:
+            self._hierarchy = EsdHierarchy(self)
+        return self._hierarchy
+
+    def get(self, uri):
+        """
+        Returns the EsdEntry of the function or service URI, or None.
+        """
+        uri = uri.strip().rstrip('/')
+        return self.services.get(uri) or self.functions.get(uri)
+
+    def label(self, uri, default=None):
+        entry = self.get(uri)
+        return entry.label if entry else default
+
+    @classmethod
+    def parse(cls, source):
+        """
+        Builds the registry from the ESD XML file (path or file-like),
+        streaming it rather than building the whole tree.
+        """
+        tables = {'Function': {}, 'Service': {}}
+        for event, node in lxml.etree.iterparse(source, events=('end',)):
+            if node.tag not in tables:
+                continue
+            fields = {}
+            for child in node:
+                if child.tag in INTERESING_TAG_LIST:
+                    fields[child.tag.lower()] = "".join(child.itertext())
+            # Function > Functions|Services > Function|Service
+            container = node.getparent()
+            owner = container.getparent() if container is not None else None
+            parent = owner.findtext('URI') \
+                if owner is not None and owner.tag == 'Function' else None
+            entry = EsdEntry(fields.get('uri'), fields.get('identifier'),
+                             fields.get('label'), fields.get('description'),
+                             parent)
+            tables[node.tag][entry.uri] = entry
+            # nested functions have been dealt with, so drop them too
+            node.clear()
+        return cls(tables['Function'], tables['Service'])
+
+    @classmethod
+    def load_index(cls, path):
+        with open(path, 'r') as f:
+            index = json.load(f)
+        return index, cls(
+            dict((entry[0], EsdEntry(*entry)) for entry in index['functions']),
+            dict((entry[0], EsdEntry(*entry)) for entry in index['services']))
+
+    def save_index(self, path, source_stat):
+        index = {'version': INDEX_VERSION,
+                 'source_stat': source_stat,
+                 'functions': self.functions.values(),
+                 'services': self.services.values()}
+        # write then rename, so other processes never load a partial index
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(index, f)
+        os.rename(tmp_path, path)
+
+
+class EsdHierarchy(object):
+    """
+    The function/service hierarchy with its transitive closure precomputed,
+    so that rolling a service up to all the functions above it, or expanding
+    a function to all the services below it, is a lookup.
+
+    Each function and service has an integer id, and the closure is held as
+    arrays of ids, one per function or service.
+    """
+
+    def __init__(self, registry):
+        # functions first, so a function's id is less than len(functions)
+        self.uris = sorted(registry.functions) + sorted(registry.services)
+        self.ids = dict((uri, i) for i, uri in enumerate(self.uris))
+        self.function_count = len(registry.functions)
+
+        parents = [registry.get(uri).parent for uri in self.uris]
+        parent_ids = [self.ids.get(parent, -1) for parent in parents]
+        descendants = [[] for uri in self.uris]
+        self._ancestors = []
+        for i in xrange(len(self.uris)):
+            ancestors = array('i')
+            parent_id = parent_ids[i]
+            # the hierarchy is a tree, but don't loop forever if it isn't
+            while parent_id != -1 and parent_id not in ancestors:
+                ancestors.append(parent_id)
+                descendants[parent_id].append(i)
+                parent_id = parent_ids[parent_id]
+            self._ancestors.append(ancestors)
+        self._descendants = [array('i', sorted(ids)) for ids in descendants]
+
+    def _lookup(self, uri):
+        return self.ids.get(uri.strip().rstrip('/'))
+
+    def ancestor_functions(self, uri):
+        """
+        Returns the URIs of the functions above the function or service,
+        nearest first.
+        """
+        i = self._lookup(uri)
+        if i is None:
+            return []
+        return [self.uris[j] for j in self._ancestors[i]]
+
+    def descendants(self, uri):
+        """
+        Returns the URIs of all the functions and services below the function.
+        """
+        i = self._lookup(uri)
+        if i is None:
+            return []
+        return [self.uris[j] for j in self._descendants[i]]
+
+    def descendant_services(self, uri):
+        """
+        Returns the URIs of all the services below the function.
+        """
+        i = self._lookup(uri)
+        if i is None:
+            return []
+        descendants = self._descendants[i]
+        # ids are sorted, with the functions first
+        start = bisect.bisect_left(descendants, self.function_count)
+        return [self.uris[j] for j in descendants[start:]]
+
+
+def facet_values(services, functions, registry=None):
+    """
+    Returns the values to index for a dataset's la_service and la_function
+    extras (space-separated URIs), as a dict of facet: list of URIs. The
+    functions include all those above the dataset's services and functions
+    in the hierarchy, so that searching on a function finds datasets about
+    anything under it.
+    """
+    hierarchy = (registry or esd_registry()).hierarchy
+    service_uris = _unique(uri.rstrip('/') for uri in (services or '').split())
+    function_uris = [uri.rstrip('/') for uri in (functions or '').split()]
+    for uri in service_uris + list(function_uris):
+        function_uris.extend(hierarchy.ancestor_functions(uri))
+    return {'service': service_uris, 'function': _unique(function_uris)}
 
-    def load_dict(xpath):
-        data = {}
-        for entry in doc.xpath(xpath):
-            key = entry.xpath("./URI")[0].text
-            d = {}
-            for node in entry:
-                if node.tag in INTERESING_TAG_LIST:
-                    d[node.tag.lower()] = "".join([x for x in node.itertext()])
-            data[key] = d
-        return data
 
-    functions = load_dict("//Function")
-    services = load_dict("//Service")
+def _unique(uris):
+    seen = set()
+    return [uri for uri in uris if not (uri in seen or seen.add(uri))]
 
-    data.close()
-    return {"functions": functions, "services": services}
 
+class LabelTable(object):
+    """
+    Read-only table of function/service URI: label, for rendering facets.
+
+    It is built once per process (see label_table) and never modified, so
+    when it is built before the web server forks its workers they all share
+    the parent's copy.
+    """
+
+    def __init__(self, registry):
+        labels = {}
+        for entries in (registry.functions, registry.services):
+            for uri, entry in entries.iteritems():
+                if entry.label:
+                    labels[uri] = entry.label
+        self._labels = labels
+
+    def get(self, uri, default=None):
+        label = self._labels.get(uri)
+        if label is None:
+            label = self._labels.get(uri.strip().rstrip('/'), default)
+        return label
+
+    def __len__(self):
+        return len(self._labels)
+
+
+_label_table = None
+_label_table_lock = threading.Lock()
+
+
+def label_table():
+    """
+    Returns the LabelTable, building it the first time it is needed.
+    """
+    global _label_table
+    if _label_table is None:
+        with _label_table_lock:
+            if _label_table is None:
+                _label_table = LabelTable(esd_registry())
+    return _label_table
+
+
+def _index_dir():
+    from pylons import config
+    return config.get('ckanext.dgulocal.esd_index_dir', DEFAULT_INDEX_DIR)
+
+
+def _source_stat(path):
+    stat = os.stat(path)
+    return [path, stat.st_size, int(stat.st_mtime)]
+
+
+def build_registry(index_dir=None):
+    """
+    Returns the EsdRegistry from the index file, if it was built from the
+    current source file, or else parses the source file and saves the index.
+    The source file is the refreshed copy of the list if there is one, or
+    else the bundled one.
+    """
+    index_dir = index_dir or _index_dir()
+    index_path = os.path.join(index_dir, 'index.json')
+    source = os.path.join(index_dir, 'functions_services.xml')
+    if not os.path.exists(source):
+        source = BUNDLED_FILE
+    source_stat = _source_stat(source)
+
+    try:
+        index, registry = EsdRegistry.load_index(index_path)
+        if index.get('version') == INDEX_VERSION and \
+                index.get('source_stat') == source_stat:
+            return registry
+        log.info('ESD index is out of date: %s', index_path)
+    except (IOError, ValueError, KeyError, TypeError):
+        log.info('ESD index not found, or unreadable: %s', index_path)
+
+    registry = EsdRegistry.parse(source)
+    log.info('Loaded %s ESD functions and %s services from %s',
+             len(registry.functions), len(registry.services), source)
+    try:
+        if not os.path.isdir(index_dir):
+            os.makedirs(index_dir)
+        registry.save_index(index_path, source_stat)
+    except (IOError, OSError), e:
+        log.warning('Could not save ESD index %s: %s', index_path, e)
+    return registry
+
+
+def refresh_registry(index_dir=None, url=ESD_URL):
+    """
+    Downloads the live ESD list to the index dir, where it is used in place
+    of the bundled copy, and returns the rebuilt registry.
+    """
+    global _registry, _label_table
+    index_dir = index_dir or _index_dir()
+    req = requests.get(url)
+    req.raise_for_status()
+    # check it parses before replacing the current copy
+    EsdRegistry.parse(cStringIO.StringIO(req.content))
+    if not os.path.isdir(index_dir):
+        os.makedirs(index_dir)
+    fd, tmp_path = tempfile.mkstemp(dir=index_dir)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(req.content)
+    os.rename(tmp_path, os.path.join(index_dir, 'functions_services.xml'))
+    with _registry_lock:
+        _registry = build_registry(index_dir)
+    _label_table = None
+    return _registry
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def esd_registry():
+    """
+    Returns the EsdRegistry, loading it the first time it is needed.
+    """
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = build_registry()
+    return _registry
@@ -0,0 +1,47 @@
+"""
+Stamp files, for telling other processes (e.g. web workers) that something
+they hold in memory is out of date.
+
+A process that changes the data touches the stamp, and the processes holding
+copies check its mtime - a single stat() - before using them.
+"""
+import os
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class ChangeStamp(object):
+    """
+        stamp = ChangeStamp('/tmp/my.stamp')
+        ...
+        if stamp.changed():
+            reload()
+        ...
+        stamp.touch()  # in the process that changes the data
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._mtime = self._read()
+
+    def _read(self):
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
+
+    def changed(self):
+        """
+        Returns whether the stamp has been touched since this was created or
+        last returned True.
+        """
+        mtime = self._read()
+        if mtime == self._mtime:
+            return False
+        self._mtime = mtime
+        return True
+
+    def touch(self):
+        with open(self.path, 'a'):
+            os.utime(self.path, None)
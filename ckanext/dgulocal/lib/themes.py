@@ -0,0 +1,76 @@
+"""
+Index of the DGU themes for each ESD service and function URI, used to
+categorise harvested datasets by their la_service/la_function.
+
+The mapping is static (data/service_function_themes.json, derived from the
+LGA's functions_services_themes.csv) so it is loaded once per process.
+"""
+import os
+import json
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+THEMES_FILE = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                           '../data/service_function_themes.json'))
+
+SERVICE_URI = 'http://id.esd.org.uk/service/%s'
+FUNCTION_URI = 'http://id.esd.org.uk/function/%s'
+
+# LGA provided CSV doesn't use the DGU theme names
+THEME_NAME_MAP = {
+    'Crime and justice': 'Crime & Justice',
+    'Health': 'Health',
+    'Government': 'Government',
+    'Towns and cities': 'Towns & Cities',
+    'Environment': 'Environment',
+    'Society': 'Society',
+    'Government spending': 'Government Spending',
+    'Business and economy': 'Economy & Business',
+    'Education': 'Education',
+    'Transport': 'Transport',
+}
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def _load_index(path=THEMES_FILE):
+    with open(path, 'r') as f:
+        data = json.load(f)
+    index = {}
+    for key, uri_pattern in (('services', SERVICE_URI),
+                             ('functions', FUNCTION_URI)):
+        for identifier, themes in data.get(key, {}).iteritems():
+            index[uri_pattern % identifier] = tuple(
+                THEME_NAME_MAP.get(theme, theme) for theme in themes)
+    log.debug('Loaded themes for %s services and functions', len(index))
+    return index
+
+
+def theme_index():
+    """
+    Returns the dict of service/function URI: tuple of themes, loading it
+    the first time it is needed.
+    """
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = _load_index()
+    return _index
+
+
+def themes_for_uris(uris):
+    """
+    Returns the themes for the given service and function URIs, in the order
+    the URIs are given and without duplicates. Unknown URIs are ignored.
+    """
+    index = theme_index()
+    themes = []
+    for uri in uris:
+        for theme in index.get(uri.strip().rstrip('/'), ()):
+            if theme not in themes:
+                themes.append(theme)
+    return themes
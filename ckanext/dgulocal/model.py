@@ -10,6 +10,9 @@ from ckan.model import Session
 from ckan.model import meta
 from ckan.model.domain_object import DomainObject
 
+from ckanext.dgulocal.lib.geo import (RESOLUTIONS, FULL_RESOLUTION,
+                                      simplified_geometries)
+
 log = getLogger(__name__)
 
 
@@ -17,6 +20,9 @@ DEFAULT_SRID = 4326  # (WGS 84)
 
 
 def init_tables(engine):
+    from ckanext.dgulocal.lib.names import init_name_reservation_table
+    init_name_reservation_table(engine)
+
     if not Table('geometry_columns', meta.metadata).exists() or \
        not Table('spatial_ref_sys', meta.metadata).exists():
         raise Exception('PostGIS has not been set up in the database. Please '
@@ -38,6 +44,42 @@ def init_tables(engine):
     else:
         log.debug('organization_extent table already exists in the db')
         # Future migrations go here
+        add_simplified_geometry_columns()
+
+
+def add_simplified_geometry_columns():
+    '''
+    Migration adding the simplified geometry columns to an existing
+    organization_extent table, filled in from the_geom.
+    '''
+    existing = set(column for column, in Session.execute(
+        "SELECT f_geometry_column FROM geometry_columns "
+        "WHERE f_table_name = 'organization_extent'"))
+    for name, tolerance in RESOLUTIONS:
+        column = geometry_column_name(name)
+        if column in existing:
+            continue
+        Session.execute(
+            "SELECT AddGeometryColumn('organization_extent', :column, "
+            ":srid, 'GEOMETRY', 2)", {'column': column, 'srid': db_srid})
+        Session.execute(
+            'UPDATE organization_extent SET %s = '
+            'ST_SimplifyPreserveTopology(the_geom, :tolerance)' % column,
+            {'tolerance': tolerance})
+        Session.commit()
+        log.info('Added column organization_extent.%s', column)
+
+
+def geometry_column_name(resolution=FULL_RESOLUTION):
+    '''
+    Returns the name of the organization_extent column with the geometry at
+    the given resolution - FULL_RESOLUTION or one of geo.RESOLUTIONS.
+    '''
+    if resolution == FULL_RESOLUTION:
+        return 'the_geom'
+    if resolution not in dict(RESOLUTIONS):
+        raise ValueError('Unknown resolution: %r' % resolution)
+    return 'the_geom_%s' % resolution
 
 
 class OrganizationExtent(DomainObject):
@@ -45,11 +87,27 @@ class OrganizationExtent(DomainObject):
         self.organization_id = organization_id
         self.the_geom = the_geom
 
+    def get_geom(self, resolution=FULL_RESOLUTION):
+        '''
+        Returns the extent at the given resolution (see
+        geo.resolution_for_tolerance), e.g. 'coarse' for drawing a small map.
+        '''
+        return getattr(self, geometry_column_name(resolution))
+
+    @classmethod
+    def geom_column(cls, resolution=FULL_RESOLUTION):
+        '''
+        Returns the mapped geometry column for the given resolution, for use
+        in queries.
+        '''
+        return getattr(cls, geometry_column_name(resolution))
+
 
 def set_organization_polygon(orgid, geojson):
     from geoalchemy import WKTSpatialElement
     from shapely.geometry import asShape
     from ckanext.dgulocal.model import OrganizationExtent
+    from ckanext.dgulocal.lib.authorities import invalidate_authority_index
 
     if not orgid:
         log.error('No organization provided')
@@ -61,7 +119,12 @@ def set_organization_polygon(orgid, geojson):
     if not extent:
         extent = OrganizationExtent(organization_id=orgid)
     extent.the_geom = WKTSpatialElement(shape.wkt, db_srid)
+    # Simplified at ingest, so readers needn't ship the full coastline
+    for name, simplified in simplified_geometries(shape).iteritems():
+        setattr(extent, geometry_column_name(name),
+                WKTSpatialElement(simplified.wkt, db_srid))
     extent.save()
+    invalidate_authority_index()
 
 
 db_srid = int(config.get('ckan.spatial.srid', DEFAULT_SRID))
@@ -69,15 +132,19 @@ db_srid = int(config.get('ckan.spatial.srid', DEFAULT_SRID))
 organization_extent_table = Table(
     'organization_extent', meta.metadata,
     Column('organization_id', types.UnicodeText, primary_key=True),
-    GeometryExtensionColumn('the_geom', Geometry(2, srid=db_srid))
+    GeometryExtensionColumn('the_geom', Geometry(2, srid=db_srid)),
+    *[GeometryExtensionColumn(geometry_column_name(name),
+                              Geometry(2, srid=db_srid))
+      for name, tolerance in RESOLUTIONS]
     )
 
 
 meta.mapper(OrganizationExtent, organization_extent_table,
-            properties={
-                'the_geom': GeometryColumn(organization_extent_table.c.the_geom,
-                                           comparator=PGComparator)
-            })
+            properties=dict(
+                (column.name, GeometryColumn(column, comparator=PGComparator))
+                for column in organization_extent_table.columns
+                if column.name.startswith('the_geom')
+            ))
 
 # enable the DDL extension
 GeometryDDL(organization_extent_table)
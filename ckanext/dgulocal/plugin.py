@@ -21,6 +21,7 @@ from ckan.plugins import IConfigurer
 from ckan.plugins import ITemplateHelpers
 from ckan.plugins import IAuthFunctions
 from ckan.plugins import IActions
+from ckan.plugins import IPackageController
 import ckan.plugins.toolkit as toolkit
 from ckan.config.routing import SubMapper
 
@@ -42,6 +43,8 @@ class LocalPlugin(SingletonPlugin):
     implements(IConfigurer)
     implements(IFacets)
     implements(IDatasetForm)
+    implements(IPackageController, inherit=True)
+    implements(ITemplateHelpers)
 
     from ckan.controllers.package import PackageController
     PackageController._guess_package_type = _guess_package_type
@@ -55,11 +58,41 @@ class LocalPlugin(SingletonPlugin):
         return facets_dict
 
 
+    ## IPackageController
+
+    def before_index(self, pkg_dict):
+        # The harvester stores services and functions as space-separated
+        # URIs, so index them as multi-valued fields for the facets
+        services = pkg_dict.get('extras_la_service')
+        functions = pkg_dict.get('extras_la_function')
+        if services is None and functions is None:
+            return pkg_dict
+        from ckanext.dgulocal.lib.services import facet_values
+        pkg_dict.update(facet_values(services, functions))
+        if pkg_dict.get('organization'):
+            pkg_dict['local'] = pkg_dict['organization']
+        return pkg_dict
+
+
     # IConfigurer
 
     def update_config(self, config):
         toolkit.add_template_directory(config, 'theme/templates')
         toolkit.add_public_directory(config, 'theme/public')
+        # Load the labels now, before the server forks any workers, so that
+        # they share one copy
+        from ckanext.dgulocal.lib.services import label_table
+        label_table()
+
+
+    ## ITemplateHelpers
+
+    def get_helpers(self):
+        from ckanext.dgulocal.lib import helpers
+        return {
+            'dgulocal_esd_label': helpers.esd_label,
+            'dgulocal_esd_facet_items': helpers.esd_facet_items,
+        }
 
 
     ## IRoutes
@@ -76,14 +109,23 @@ class LocalPlugin(SingletonPlugin):
     ## IAuthFunctions
 
     def get_auth_functions(self):
+        from ckanext.dgulocal.actions import (local_authority_for_point_auth,
+                                              local_search_cache_stats_auth)
         return {
+            'local_authority_for_point': local_authority_for_point_auth,
+            'local_search_cache_stats': local_search_cache_stats_auth,
         }
 
 
     ## IActions
 
     def get_actions(self):
-        return {}
+        from ckanext.dgulocal.actions import (local_authority_for_point,
+                                              local_search_cache_stats)
+        return {
+            'local_authority_for_point': local_authority_for_point,
+            'local_search_cache_stats': local_search_cache_stats,
+        }
 
 
     ## IDatasetForm
@@ -0,0 +1,63 @@
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_equal
+from shapely.geometry import Polygon, box
+
+from mock import patch
+
+from ckanext.dgulocal.lib.authorities import (AuthorityIndex,
+                                             LazyAuthorityIndex)
+
+
+class TestAuthorityIndex:
+
+    def setup(self):
+        # x is latitude, as in the stored boundaries
+        self.county = box(52.0, -1.0, 53.0, 0.0)
+        self.district = Polygon([(52.1, -0.9), (52.4, -0.9), (52.1, -0.6)])
+        self.index = AuthorityIndex([('county', self.county),
+                                     ('district', self.district),
+                                     ('elsewhere', box(54.0, -3.0, 55.0, -2.0)),
+                                     ('no-boundary', None)])
+
+    def test_lookup(self):
+        assert_equal(self.index.lookup(52.5, -0.5), ['county'])
+        assert_equal(self.index.lookup(54.5, -2.5), ['elsewhere'])
+
+    def test_smallest_first(self):
+        assert_equal(self.index.lookup(52.15, -0.85), ['district', 'county'])
+
+    def test_in_bbox_but_not_polygon(self):
+        # inside the district's bounding box, outside its triangle
+        assert_equal(self.index.lookup(52.35, -0.65), ['county'])
+
+    def test_outside(self):
+        assert_equal(self.index.lookup(40.0, 10.0), [])
+
+    def test_empty(self):
+        assert_equal(AuthorityIndex([]).lookup(52.5, -0.5), [])
+
+
+class TestLazyAuthorityIndex:
+
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.stamp_file = os.path.join(self.tmp_dir, 'stamp')
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_rebuilt_when_another_process_invalidates(self):
+        lazy_index = LazyAuthorityIndex(stamp_file=self.stamp_file)
+        with patch.object(AuthorityIndex, 'from_db',
+                          side_effect=lambda resolution: AuthorityIndex([])) \
+                as from_db:
+            lazy_index.get()
+            lazy_index.get()
+            assert_equal(from_db.call_count, 1)
+            # e.g. load-boundaries
+            LazyAuthorityIndex(stamp_file=self.stamp_file).invalidate()
+            lazy_index.get()
+            assert_equal(from_db.call_count, 2)
@@ -0,0 +1,48 @@
+import os
+
+from nose.tools import assert_equal, assert_raises
+
+from ckanext.dgulocal.lib.boundaries import (iter_features, gss_code,
+                                             boundary_shape, BoundaryFileError)
+
+BOUNDARIES = os.path.join(os.path.dirname(__file__), 'data',
+                          'boundaries.geojson')
+
+
+class TestBoundaryFile:
+
+    def test_iter_features(self):
+        features = list(iter_features(BOUNDARIES))
+        assert_equal(len(features), 3)
+        properties, geometry = features[0]
+        assert_equal(properties['lad21nm'], 'Peterborough')
+        assert_equal(geometry['type'], 'Polygon')
+
+    def test_gss_code(self):
+        assert_equal([gss_code(properties)
+                      for properties, geometry in iter_features(BOUNDARIES)],
+                     ['E06000031', 'E07000011', None])
+
+    def test_gss_code_ambiguous(self):
+        properties = {'LAD21CD': 'E07000011', 'CTY21CD': 'E10000003',
+                      'LAD21NM': 'Huntingdonshire'}
+        assert_equal(gss_code(properties), None)
+        assert_equal(gss_code(properties, 'LAD21CD'), 'E07000011')
+        assert_equal(gss_code(properties, 'CTY21CD'), 'E10000003')
+
+    def test_gss_code_property(self):
+        properties = {'LAD21CD': ' E07000011 ', 'LAD21NM': 'Huntingdonshire'}
+        assert_equal(gss_code(properties, 'LAD21CD'), 'E07000011')
+        assert_equal(gss_code(properties, 'LAD21NM'), None)
+        assert_equal(gss_code(properties, 'missing'), None)
+
+    def test_boundary_shape_has_latitude_first(self):
+        properties, geometry = next(iter_features(BOUNDARIES))
+        assert_equal(boundary_shape(geometry).bounds,
+                     (52.5, -0.5, 52.7, -0.1))
+
+    def test_boundary_shape_not_wgs84(self):
+        geometry = {'type': 'Polygon',
+                    'coordinates': [[[518000, 298000], [520000, 298000],
+                                     [520000, 300000], [518000, 298000]]]}
+        assert_raises(BoundaryFileError, boundary_shape, geometry)
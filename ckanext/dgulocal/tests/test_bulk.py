@@ -0,0 +1,49 @@
+from nose.tools import assert_equal
+
+from ckan import model
+from ckanext.harvest.model import (HarvestSource, HarvestJob, HarvestObject,
+                                   HarvestObjectExtra)
+from ckanext.dgulocal.lib.bulk import HarvestObjectWriter
+
+
+class TestHarvestObjectWriter:
+
+    def setup(self):
+        source = HarvestSource(url=u'http://test.com/inventory.xml',
+                               type=u'inventory')
+        source.save()
+        self.job = HarvestJob(source=source)
+        self.job.save()
+
+    def teardown(self):
+        model.repo.rebuild_db()
+
+    def _add(self, writer, guid):
+        return writer.add(guid=guid, package_id=None, content=u'<x/>',
+                          metadata_modified_date=None,
+                          extras={'status': 'new'})
+
+    def test_inserts_in_chunks(self):
+        writer = HarvestObjectWriter(self.job, chunk_size=2)
+        ids = [self._add(writer, guid) for guid in ('a', 'b', 'c')]
+        # the first chunk is inserted straight away
+        assert_equal(model.Session.query(HarvestObject).count(), 2)
+        writer.flush()
+        assert_equal(writer.ids, ids)
+
+        obj = HarvestObject.get(ids[2])
+        assert_equal(obj.guid, 'c')
+        assert_equal(obj.harvest_job_id, self.job.id)
+        assert_equal(obj.harvest_source_id, self.job.source_id)
+        assert obj.gathered
+        assert_equal([(e.key, e.value) for e in obj.extras], [('status', 'new')])
+
+    def test_discard(self):
+        writer = HarvestObjectWriter(self.job, chunk_size=2)
+        for guid in ('a', 'b', 'c'):
+            self._add(writer, guid)
+        writer.discard()
+        writer.flush()
+        assert_equal(writer.ids, [])
+        assert_equal(model.Session.query(HarvestObject).count(), 0)
+        assert_equal(model.Session.query(HarvestObjectExtra).count(), 0)
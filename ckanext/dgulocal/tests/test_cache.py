@@ -0,0 +1,62 @@
+import time
+
+from mock import patch
+from nose.tools import assert_equal
+
+from ckanext.dgulocal.lib.cache import LRUCache, TTLCache, JobScopedCache
+
+
+class TestLRUCache:
+
+    def test_memoizes(self):
+        calls = []
+        def lookup(x):
+            calls.append(x)
+            return x * 2
+        cache = LRUCache()
+        assert_equal(cache.get(('double', 2), lookup, 2), 4)
+        assert_equal(cache.get(('double', 2), lookup, 2), 4)
+        assert_equal(calls, [2])
+        assert_equal((cache.hits, cache.misses), (1, 1))
+
+    def test_bounded(self):
+        cache = LRUCache(maxsize=2)
+        cache.get('a', lambda: 1)
+        cache.get('b', lambda: 2)
+        cache.get('a', lambda: 1)  # 'b' is now least recently used
+        cache.get('c', lambda: 3)
+        assert_equal(len(cache), 2)
+        assert_equal(cache.get('a', lambda: 'recomputed'), 1)
+        assert_equal(cache.get('b', lambda: 'recomputed'), 'recomputed')
+
+    def test_invalidate(self):
+        cache = LRUCache()
+        cache.get('a', lambda: 1)
+        cache.get('b', lambda: 2)
+        cache.invalidate('a')
+        assert_equal(cache.get('a', lambda: 'recomputed'), 'recomputed')
+        cache.invalidate()
+        assert_equal(len(cache), 0)
+
+
+class TestJobScopedCache:
+
+    def test_emptied_for_new_job(self):
+        cache = JobScopedCache()
+        cache.for_job('job1').get('a', lambda: 1)
+        assert_equal(cache.for_job('job1').get('a', lambda: 2), 1)
+        assert_equal(cache.for_job('job2').get('a', lambda: 2), 2)
+        assert_equal((cache.hits, cache.misses), (0, 1))
+
+
+class TestTTLCache:
+
+    def test_expires(self):
+        cache = TTLCache(ttl=60)
+        now = time.time()
+        assert_equal(cache.get('a', lambda: 1), 1)
+        assert_equal(cache.get('a', lambda: 2), 1)
+        with patch('time.time', return_value=now + 61):
+            assert_equal(cache.get('a', lambda: 3), 3)
+        assert_equal((cache.hits, cache.misses), (1, 2))
+        assert_equal(cache.hit_rate, 1 / 3.0)
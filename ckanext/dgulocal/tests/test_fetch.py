@@ -0,0 +1,82 @@
+import shutil
+import tempfile
+
+from nose.tools import assert_equal, assert_raises
+
+from ckanext.dgulocal.lib.fetch import (FetchCache, conditional_get,
+                                        DownloadTooLarge)
+
+from xml_file_server import serve, PORT
+
+# Start simple HTTP server that serves XML test files
+serve()
+
+URL = 'http://127.0.0.1:%s/esdInventory_live_truncated.xml' % PORT
+
+
+class TestFetchCache:
+
+    def setup(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = FetchCache(self.cache_dir)
+
+    def teardown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_get_missing(self):
+        assert_equal(self.cache.get('source-id', URL), {})
+
+    def test_set_and_get(self):
+        entry = {'url': URL, 'etag': None, 'last_modified': 'x',
+                 'checksum': 'abc'}
+        self.cache.set('source-id', entry)
+        assert_equal(self.cache.get('source-id', URL), entry)
+        # the source's URL has changed
+        assert_equal(self.cache.get('source-id', URL + '?v=2'), {})
+        self.cache.clear('source-id')
+        assert_equal(self.cache.get('source-id', URL), {})
+
+
+class TestConditionalGet:
+
+    def test_first_fetch(self):
+        body, entry, unchanged = conditional_get(URL, {})
+        assert_equal(unchanged, False)
+        content = body.read()
+        assert content.startswith('<?xml')
+        assert_equal(entry['size'], len(content))
+        assert_equal(entry['url'], URL)
+        assert entry['checksum']
+        assert entry['last_modified']
+
+    def test_refetch_unchanged(self):
+        body, entry, unchanged = conditional_get(URL, {})
+        body, entry_, unchanged = conditional_get(URL, entry)
+        assert_equal(unchanged, True)
+        assert_equal(body, None)
+        assert_equal(entry_['checksum'], entry['checksum'])
+
+    def test_refetch_not_modified(self):
+        body, entry, unchanged = conditional_get(URL, {})
+        # the server replies 304, so the checksum is not compared
+        entry.update(checksum='out of date')
+        body, entry_, unchanged = conditional_get(URL, entry)
+        assert_equal(unchanged, True)
+        assert_equal(body, None)
+        assert_equal(entry_, entry)
+
+    def test_refetch_changed(self):
+        body, entry, unchanged = conditional_get(URL, {})
+        entry.update(checksum='out of date', last_modified=None)
+        body, entry_, unchanged = conditional_get(URL, entry)
+        assert_equal(unchanged, False)
+        assert entry_['checksum'] != 'out of date'
+
+    def test_spooled_to_disk(self):
+        body, entry, unchanged = conditional_get(URL, {}, spool_size=1024)
+        assert body._rolled
+        assert_equal(len(body.read()), entry['size'])
+
+    def test_too_large(self):
+        assert_raises(DownloadTooLarge, conditional_get, URL, {},
+                      max_size=1024)
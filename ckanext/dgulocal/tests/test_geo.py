@@ -1,4 +1,10 @@
-from nose.tools import assert_equal
+import shutil
+import tempfile
+import time
+
+from mock import patch
+from nose.tools import assert_equal, assert_raises
+from shapely.geometry import Polygon
 
 import ckanext.dgulocal.lib.geo as geo
 from geoalchemy import WKTSpatialElement
@@ -25,3 +31,104 @@ class TestGeo:
         shape = asShape(geojson)
         w = WKTSpatialElement(shape.wkt, 4326)
         assert w is not None
+
+
+class TestParseCoordinates:
+
+    def test_parse(self):
+        coords = geo.parse_coordinates(' 52.5 -0.3  52.6 -0.2\n52.6 -0.3 ')
+        assert_equal(coords.shape, (3, 2))
+        assert_equal(coords.tolist(),
+                     [[52.5, -0.3], [52.6, -0.2], [52.6, -0.3]])
+        assert Polygon(coords).equals(
+            Polygon([(52.5, -0.3), (52.6, -0.2), (52.6, -0.3)]))
+
+    def test_odd_number(self):
+        assert_raises(ValueError, geo.parse_coordinates, '52.5 -0.3 52.6')
+
+    def test_not_a_number(self):
+        assert_raises(ValueError, geo.parse_coordinates, '52.5 -0.3 x -0.2')
+        assert_raises(ValueError, geo.parse_coordinates, '52.5 -0.3 52.6 x')
+
+    def test_nan(self):
+        assert_raises(ValueError, geo.parse_coordinates, '52.5 -0.3 nan -0.2')
+
+    def test_unicode(self):
+        assert_equal(geo.parse_coordinates(u'52.5 -0.3').tolist(),
+                     [[52.5, -0.3]])
+
+
+class TestSimplifiedGeometries:
+
+    def test_simplified(self):
+        # a jagged circle of 2000 vertices
+        import math
+        coords = [(52.57 + (0.1 + 0.001 * (i % 2)) * math.sin(i * math.pi / 1000),
+                   -0.24 + (0.1 + 0.001 * (i % 2)) * math.cos(i * math.pi / 1000))
+                  for i in xrange(2000)]
+        polygon = Polygon(coords)
+        simplified = geo.simplified_geometries(polygon)
+        assert_equal(sorted(simplified), ['coarse', 'fine', 'medium'])
+        sizes = [len(simplified[name].exterior.coords)
+                 for name in ('fine', 'medium', 'coarse')]
+        assert len(coords) + 1 >= sizes[0] > sizes[1] > sizes[2], sizes
+        for geom in simplified.values():
+            assert geom.is_valid
+            assert abs(geom.area - polygon.area) / polygon.area < 0.1
+
+    def test_resolution_for_tolerance(self):
+        assert_equal(geo.resolution_for_tolerance(0), 'full')
+        assert_equal(geo.resolution_for_tolerance(0.0001), 'fine')
+        assert_equal(geo.resolution_for_tolerance(0.005), 'medium')
+        assert_equal(geo.resolution_for_tolerance(1), 'coarse')
+
+
+class TestBoundaryCache:
+
+    def setup(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = geo.BoundaryCache(self.cache_dir, ttl=60)
+        self.polygon = Polygon([(52.5, -0.3), (52.6, -0.2), (52.6, -0.3)])
+
+    def teardown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_get_missing(self):
+        assert_equal(self.cache.get('http://example.com/la'), (None, False))
+
+    def test_set_and_get(self):
+        self.cache.set('http://example.com/la', 'http://example.com/gss.json',
+                       self.polygon)
+        polygon, fresh = self.cache.get('http://example.com/la')
+        assert polygon.equals(self.polygon)
+        assert_equal(fresh, True)
+        assert_equal(list(self.cache.urls()), ['http://example.com/la'])
+
+    def test_stale(self):
+        self.cache.set('http://example.com/la', 'http://example.com/gss.json',
+                       self.polygon)
+        with patch('time.time', return_value=time.time() + 61):
+            polygon, fresh = self.cache.get('http://example.com/la')
+        assert polygon.equals(self.polygon)
+        assert_equal(fresh, False)
+
+    def test_get_cached_boundary_does_not_block(self):
+        with patch('ckanext.dgulocal.lib.geo._refresh_in_background') as refresh:
+            assert_equal(geo.get_cached_boundary('http://example.com/la',
+                                                 self.cache), None)
+            assert refresh.called
+        self.cache.set('http://example.com/la', 'http://example.com/gss.json',
+                       self.polygon)
+        with patch('ckanext.dgulocal.lib.geo._refresh_in_background') as refresh:
+            assert geo.get_cached_boundary('http://example.com/la',
+                                           self.cache).equals(self.polygon)
+            assert not refresh.called
+
+    def test_refresh_boundary(self):
+        with patch('ckanext.dgulocal.lib.geo.resolve_gss_url',
+                   return_value='http://example.com/gss.json'), \
+                patch('ckanext.dgulocal.lib.geo.fetch_boundary',
+                      return_value=self.polygon):
+            geo.refresh_boundary('http://example.com/la', self.cache)
+        polygon, fresh = self.cache.get('http://example.com/la')
+        assert polygon.equals(self.polygon)
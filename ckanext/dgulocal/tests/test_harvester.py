@@ -1,10 +1,15 @@
+import datetime
 import json
 from pprint import pprint
 
-from nose.tools import assert_equal
+from mock import patch
+from nose.tools import assert_equal, assert_raises
 
-from ckanext.harvest.harvesters.dgu_base import PackageDictDefaults
-from ckanext.dgulocal.harvester import InventoryHarvester
+from ckanext.harvest.harvesters.dgu_base import (PackageDictDefaults,
+                                                 DguHarvesterBase)
+from ckan import model
+from ckanext.harvest.model import HarvestSource, HarvestJob, HarvestObject
+from ckanext.dgulocal.harvester import InventoryHarvester, PackageUnchanged
 from ckan.new_tests import factories
 
 class MockObject(dict):
@@ -44,7 +49,7 @@ class TestGetPackageDict:
     </inv:Dataset>
         '''
         harvest_source = MockObject(publisher_id=self.publisher['id'])
-        harvest_job = MockObject(source=harvest_source)
+        harvest_job = MockObject(id='test-job', source=harvest_source)
         harvest_object = MockObject(
                 job=harvest_job,
                 content=content,
@@ -57,7 +62,8 @@ class TestGetPackageDict:
         harvest_object = self._get_test_harvest_object()
         package_dict_defaults = PackageDictDefaults()
         source_config = {}
-        existing_pkg = MockObject(resources=[])
+        existing_pkg = MockObject(id='test-pkg', title='Old title',
+                                  resources=[])
         pkg_dict = h.get_package_dict(harvest_object, package_dict_defaults,
                                       source_config, existing_pkg)
         pkg_dict['extras'] = sorted(pkg_dict['extras'])
@@ -81,3 +87,239 @@ class TestGetPackageDict:
                        {'key': 'la_function', 'value': ''},
                        {'key': 'la_service', 'value': ''}],
             })
+
+
+class TestPackageChanged:
+
+    def _existing_pkg(self):
+        resource = MockObject(id='res-id', url='http://test.com/file.csv',
+                              format='CSV', description='Some file',
+                              resource_type='file', extras={})
+        return MockObject(title=u'Test dataset', notes=u'Test description',
+                          license_id='uk-ogl', state='active',
+                          extras={'la_service': ''}, resources=[resource])
+
+    def _pkg(self):
+        return {'title': 'Test dataset', 'notes': 'Test description',
+                'license_id': 'uk-ogl', 'state': 'active',
+                'extras': {'la_service': ''},
+                'resources': [{'id': 'res-id',
+                               'url': 'http://test.com/file.csv',
+                               'format': 'CSV',
+                               'description': 'Some file',
+                               'resource_type': 'file',
+                               'schema-url': ''}]}
+
+    def test_unchanged(self):
+        assert_equal(InventoryHarvester._package_changed(
+            self._pkg(), self._existing_pkg()), False)
+
+    def test_changed_field(self):
+        pkg = self._pkg()
+        pkg['notes'] = 'New description'
+        assert_equal(InventoryHarvester._package_changed(
+            pkg, self._existing_pkg()), True)
+
+    def test_changed_extra(self):
+        pkg = self._pkg()
+        pkg['extras']['la_service'] = 'http://id.esd.org.uk/service/190'
+        assert_equal(InventoryHarvester._package_changed(
+            pkg, self._existing_pkg()), True)
+
+    def test_new_resource(self):
+        pkg = self._pkg()
+        pkg['resources'].append({'url': 'http://test.com/file2.csv'})
+        assert_equal(InventoryHarvester._package_changed(
+            pkg, self._existing_pkg()), True)
+
+    def test_changed_resource_extra(self):
+        pkg = self._pkg()
+        pkg['resources'][0]['schema-url'] = 'http://test.com/schema.json'
+        assert_equal(InventoryHarvester._package_changed(
+            pkg, self._existing_pkg()), True)
+
+
+class TestClassifyDataset:
+
+    def test_new(self):
+        assert_equal(InventoryHarvester._classify_dataset(
+            None, 'digest', datetime.date(2014, 1, 1)), ('new', None))
+
+    def test_digest_unchanged_despite_date(self):
+        current = ('pkg-id', datetime.datetime(2013, 1, 1), 'digest')
+        assert_equal(InventoryHarvester._classify_dataset(
+            current, 'digest', datetime.date(2014, 1, 1)),
+            ('unchanged (digest)', 'pkg-id'))
+
+    def test_digest_changed(self):
+        current = ('pkg-id', datetime.datetime(2014, 1, 1), 'digest')
+        assert_equal(InventoryHarvester._classify_dataset(
+            current, 'new digest', datetime.date(2014, 1, 1)),
+            ('changed', 'pkg-id'))
+
+    def test_no_digest_newer_date(self):
+        current = ('pkg-id', datetime.datetime(2013, 1, 1), None)
+        assert_equal(InventoryHarvester._classify_dataset(
+            current, 'digest', datetime.date(2014, 1, 1)),
+            ('changed', 'pkg-id'))
+
+    def test_no_digest_same_date(self):
+        current = ('pkg-id', datetime.datetime(2014, 1, 1), None)
+        assert_equal(InventoryHarvester._classify_dataset(
+            current, 'digest', datetime.date(2014, 1, 1)),
+            ('unchanged (date)', 'pkg-id'))
+
+
+class TestForgetFetch:
+
+    def _import(self, result):
+        harvest_object = MockObject(id='obj-id', harvest_source_id='source-id')
+        with patch.object(DguHarvesterBase, 'import_stage',
+                          return_value=result), \
+                patch('ckanext.dgulocal.harvester.FetchCache') as fetch_cache, \
+                patch('ckanext.dgulocal.harvester.invalidate_search_cache') \
+                as invalidate:
+            InventoryHarvester().import_stage(harvest_object)
+        return fetch_cache.from_config.return_value.clear, invalidate
+
+    def test_failed_import_clears_fetch_cache(self):
+        clear, invalidate = self._import(False)
+        clear.assert_called_once_with('source-id')
+        assert not invalidate.called
+
+    def test_successful_import_keeps_fetch_cache(self):
+        clear, invalidate = self._import(True)
+        assert not clear.called
+        invalidate.assert_called_once_with()
+
+
+class TestImportStats:
+
+    def test_reset_for_new_job(self):
+        harvester = InventoryHarvester()
+        with patch.object(InventoryHarvester, 'import_stats',
+                          {'job_id': None, 'unchanged': 0}):
+            harvester._import_stats_for_job('job1')['unchanged'] += 2
+            assert_equal(harvester._import_stats_for_job('job1'),
+                         {'job_id': 'job1', 'unchanged': 2})
+            assert_equal(harvester._import_stats_for_job('job2'),
+                         {'job_id': 'job2', 'unchanged': 0})
+
+
+class TestUnchangedPackageSkipped:
+
+    @classmethod
+    def setup_class(cls):
+        cls.publisher = factories.Organization(title='Cabinet Office',
+                                               category='ministerial-department')
+
+    def _harvest_object(self, content):
+        harvest_source = MockObject(publisher_id=self.publisher['id'])
+        harvest_job = MockObject(id='test-job', source=harvest_source)
+        return MockObject(job=harvest_job, content=content, guid='testguid')
+
+    def _existing_pkg(self):
+        import ckanext.dgu.lib.theme as dgutheme
+        resource = MockObject(id='res-id', url=u'http://test.com/file.csv',
+                              format='CSV',
+                              description=u'Some file - Download',
+                              resource_type='file',
+                              extras={'schema-url': '', 'schema-type': ''})
+        return MockObject(
+            id='test-pkg', name='test-dataset-co', title=u'Test dataset',
+            notes=u'Test description', license_id='uk-ogl', state='active',
+            extras={'inventory_identifier': 'payments_over_500',
+                    'harvest_source_reference': 'testguid',
+                    'la_service': 'http://id.esd.org.uk/service/190',
+                    'la_function': '',
+                    dgutheme.PRIMARY_THEME: 'Society',
+                    # set by the base harvester, differently every time
+                    'harvest_object_id': 'previous-object-id',
+                    'metadata-date': '2013-12-01'},
+            resources=[resource])
+
+    def _package_dict_defaults(self):
+        # as DguHarvesterBase.import_stage gives them
+        defaults = PackageDictDefaults()
+        defaults['name'] = 'test-dataset-co'
+        defaults['owner_org'] = self.publisher['id']
+        defaults['extras'] = {'import_source': 'harvest',
+                              'harvest_object_id': 'new-object-id',
+                              'metadata-date': '2014-01-01'}
+        return defaults
+
+    def _content(self, description='Test description'):
+        return '''
+    <inv:Dataset xmlns:inv="http://schemas.esd.org.uk/inventory" Modified="2014-01-01" Active="Yes">
+      <inv:Identifier>payments_over_500</inv:Identifier>
+      <inv:Title>Test dataset</inv:Title>
+      <inv:Description>%s</inv:Description>
+      <inv:Rights>http://www.nationalarchives.gov.uk/doc/open-government-licence/</inv:Rights>
+      <inv:Subjects>
+        <inv:Subject>
+          <inv:Service>http://id.esd.org.uk/service/190</inv:Service>
+        </inv:Subject>
+      </inv:Subjects>
+      <inv:Resources>
+        <inv:Resource Type="Data" Active="Yes">
+          <inv:Renditions>
+            <inv:Rendition Active="Yes">
+              <inv:Identifier>http://test.com/file.csv</inv:Identifier>
+              <inv:MimeType>text/csv</inv:MimeType>
+              <inv:Title>Some file</inv:Title>
+              <inv:Availability>Download</inv:Availability>
+            </inv:Rendition>
+          </inv:Renditions>
+        </inv:Resource>
+      </inv:Resources>
+    </inv:Dataset>
+        ''' % description
+
+    def test_date_bump_only(self):
+        assert_raises(PackageUnchanged, InventoryHarvester().get_package_dict,
+                      self._harvest_object(self._content()),
+                      self._package_dict_defaults(), {}, self._existing_pkg())
+
+    def test_changed(self):
+        pkg_dict = InventoryHarvester().get_package_dict(
+            self._harvest_object(self._content('New description')),
+            self._package_dict_defaults(), {}, self._existing_pkg())
+        assert_equal(pkg_dict['notes'], 'New description')
+
+
+class TestSaveUnchanged:
+
+    def setup(self):
+        self.package = factories.Dataset()
+        source = HarvestSource(url=u'http://test.com/inventory.xml',
+                               type=u'inventory')
+        source.save()
+        self.job = HarvestJob(source=source)
+        self.job.save()
+        self.previous = HarvestObject(guid=u'testguid', job=self.job,
+                                      package_id=self.package['id'],
+                                      current=True)
+        self.previous.save()
+        self.harvest_object = HarvestObject(guid=u'testguid', job=self.job,
+                                            content=u'<x/>')
+        self.harvest_object.save()
+
+    def teardown(self):
+        model.repo.rebuild_db()
+
+    def test_import_stage(self):
+        harvester = InventoryHarvester()
+        with patch.object(DguHarvesterBase, 'import_stage',
+                          side_effect=PackageUnchanged(self.package['id'])), \
+                patch('ckanext.dgulocal.harvester.invalidate_search_cache') \
+                as invalidate:
+            assert_equal(harvester.import_stage(self.harvest_object), True)
+        assert not invalidate.called
+
+        model.Session.expire_all()
+        harvest_object = HarvestObject.get(self.harvest_object.id)
+        assert_equal(harvest_object.current, True)
+        assert_equal(harvest_object.package_id, self.package['id'])
+        assert_equal(HarvestObject.get(self.previous.id).current, False)
+        assert_equal(harvester.import_stats,
+                     {'job_id': self.job.id, 'unchanged': 1})
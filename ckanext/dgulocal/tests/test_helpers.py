@@ -0,0 +1,40 @@
+from mock import patch
+from nose.tools import assert_equal
+
+from ckanext.dgulocal.lib import helpers, services
+
+
+class TestEsdLabels:
+
+    @classmethod
+    def setup_class(cls):
+        labels = services.LabelTable(
+            services.EsdRegistry.parse(services.BUNDLED_FILE))
+        cls.patcher = patch('ckanext.dgulocal.lib.helpers.label_table',
+                            return_value=labels)
+        cls.patcher.start()
+
+    @classmethod
+    def teardown_class(cls):
+        cls.patcher.stop()
+
+    def test_esd_label(self):
+        assert_equal(helpers.esd_label('http://id.esd.org.uk/service/190'),
+                     'Benefits advice and assessment')
+        assert_equal(helpers.esd_label('http://example.com/x'),
+                     'http://example.com/x')
+
+    def test_esd_facet_items(self):
+        items = [('service', {'name': 'http://id.esd.org.uk/service/190',
+                              'display_name': 'http://id.esd.org.uk/service/190',
+                              'count': 3}),
+                 ('service', {'name': 'unknown', 'display_name': 'unknown',
+                              'count': 1})]
+        labelled = helpers.esd_facet_items(items)
+        assert_equal(labelled[0], ('service', {
+            'name': 'http://id.esd.org.uk/service/190',
+            'display_name': 'Benefits advice and assessment', 'count': 3}))
+        assert_equal(labelled[1], items[1])
+        # the originals are not changed
+        assert_equal(items[0][1]['display_name'],
+                     'http://id.esd.org.uk/service/190')
@@ -1,9 +1,17 @@
 import os
 import datetime
+import json
+import shutil
+import tempfile
+import threading
+import cStringIO
 
 from nose.tools import assert_equal, assert_raises
 
-from ckanext.dgulocal.lib.inventory import InventoryDocument, InventoryXmlError
+from ckanext.dgulocal.lib.inventory import (InventoryDocument,
+                                            InventoryStream,
+                                            InventoryXmlError,
+                                            SchemaRegistry, DATA_DIR)
 
 
 class TestInventory:
@@ -15,6 +23,15 @@ class TestInventory:
     def test_validation_error(self):
         assert_raises(InventoryXmlError, InventoryDocument, '<tag></tag>')
 
+    def test_parse_file(self):
+        path = os.path.join(os.path.dirname(__file__), 'data',
+                            'test_inventory.xml')
+        with open(path, 'r') as f:
+            doc = InventoryDocument(f)
+            assert not f.closed
+        assert_equal(doc.top_level_metadata(),
+                     _get_inventory_doc('test_inventory.xml').top_level_metadata())
+
     def test_serialize(self):
         node = _get_inventory_doc('test_inventory.xml').dataset_nodes().next()
         node_str = InventoryDocument.serialize_node(node)
@@ -24,6 +41,42 @@ class TestInventory:
         node_str_ = InventoryDocument.serialize_node(node_)
         assert_equal(node_str.strip(), node_str_.strip())
 
+    def test_record_round_trip(self):
+        node = _get_inventory_doc('test_inventory.xml').dataset_nodes().next()
+        dataset = InventoryDocument.dataset_to_dict(node)
+        record = InventoryDocument.serialize_record(dataset, node)
+        assert_equal(InventoryDocument.record_to_dict(record), dataset)
+        assert_equal(InventoryDocument.record_to_dict(unicode(record)),
+                     dataset)
+
+    def test_record_from_xml(self):
+        # HarvestObjects from before records were introduced hold the XML
+        node = _get_inventory_doc('test_inventory.xml').dataset_nodes().next()
+        assert_equal(InventoryDocument.record_to_dict(
+                         InventoryDocument.serialize_node(node)),
+                     InventoryDocument.dataset_to_dict(node))
+
+    def test_record_other_version(self):
+        node = _get_inventory_doc('test_inventory.xml').dataset_nodes().next()
+        dataset = InventoryDocument.dataset_to_dict(node)
+        record = json.loads(InventoryDocument.serialize_record(dataset, node))
+        record['record_version'] = 0
+        record['dataset'] = {'title': 'out of date'}
+        assert_equal(InventoryDocument.record_to_dict(json.dumps(record)),
+                     dataset)
+
+    def test_digest(self):
+        node = _get_inventory_doc('test_inventory.xml').dataset_nodes().next()
+        dataset = InventoryDocument.dataset_to_dict(node)
+        digest = InventoryDocument.dataset_digest(dataset)
+        # stable through a record round-trip and regardless of dates
+        dataset_ = InventoryDocument.record_to_dict(
+            InventoryDocument.serialize_record(dataset, node))
+        dataset_['modified'] = datetime.date(2020, 1, 1)
+        assert_equal(InventoryDocument.dataset_digest(dataset_), digest)
+        dataset_['resources'][0]['url'] = 'http://example.com/changed.csv'
+        assert InventoryDocument.dataset_digest(dataset_) != digest
+
     def test_parse_top_level_metadata(self):
         doc = _get_inventory_doc('test_inventory.xml')
         metadata = doc.top_level_metadata()
@@ -50,6 +103,87 @@ class TestInventory:
         assert_equal(res['mimetype'], 'text/html')
         assert_equal(res['availability'], 'Download')
 
+class TestSchemaRegistry:
+
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.xsd = os.path.join(self.tmpdir, 'inventory.xsd')
+        shutil.copy(os.path.join(DATA_DIR, 'inventory.xsd'), self.xsd)
+        self.registry = SchemaRegistry()
+        self.registry.register('test', self.xsd)
+
+    def teardown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_compiled_once(self):
+        schema = self.registry.get_schema('test')
+        assert self.registry.get_schema('test') is schema
+        assert self.registry.get_parser('test') is \
+            self.registry.get_parser('test')
+
+    def test_parser_per_thread(self):
+        parsers = []
+        def get_parser():
+            parsers.append(self.registry.get_parser('test'))
+        thread = threading.Thread(target=get_parser)
+        thread.start()
+        thread.join()
+        assert parsers[0] is not self.registry.get_parser('test')
+
+    def test_reload_on_mtime_change(self):
+        schema = self.registry.get_schema('test')
+        mtime = os.path.getmtime(self.xsd)
+        os.utime(self.xsd, (mtime + 10, mtime + 10))
+        assert self.registry.get_schema('test') is not schema
+
+    def test_multiple_versions(self):
+        self.registry.register('test2', self.xsd)
+        assert_equal(self.registry.versions(), ['test', 'test2'])
+        assert self.registry.get_schema('test') is not \
+            self.registry.get_schema('test2')
+
+    def test_unknown_version(self):
+        assert_raises(InventoryXmlError, self.registry.get_schema, 'missing')
+
+
+class TestInventoryStream:
+
+    def test_validation_error(self):
+        stream = InventoryStream(cStringIO.StringIO('<tag></tag>'))
+        assert_raises(InventoryXmlError, stream.top_level_metadata)
+
+    def test_parse_top_level_metadata(self):
+        doc = _get_inventory_doc('esdInventory_live.xml')
+        stream = _get_inventory_stream('esdInventory_live.xml')
+        assert_equal(stream.top_level_metadata(), doc.top_level_metadata())
+
+    def test_parse_datasets(self):
+        doc = _get_inventory_doc('esdInventory_live.xml')
+        stream = _get_inventory_stream('esdInventory_live.xml')
+        datasets = [InventoryDocument.dataset_to_dict(node)
+                    for node in stream.dataset_nodes()]
+        assert_equal(datasets, [InventoryDocument.dataset_to_dict(node)
+                                for node in doc.dataset_nodes()])
+        # metadata is still available after the datasets are consumed
+        assert_equal(stream.top_level_metadata(), doc.top_level_metadata())
+
+    def test_serialize(self):
+        doc = _get_inventory_doc('test_inventory.xml')
+        stream = _get_inventory_stream('test_inventory.xml')
+        assert_equal(
+            InventoryDocument.serialize_node(stream.dataset_nodes().next()),
+            InventoryDocument.serialize_node(doc.dataset_nodes().next()))
+
+    def test_datasets_cleared(self):
+        stream = _get_inventory_stream('esdInventory_live.xml')
+        previous = None
+        for node in stream.dataset_nodes():
+            if previous is not None:
+                assert_equal(len(previous), 0)
+            previous = node
+            assert len(node)
+
+
 class TestInventoryLive:
     '''From time-to-time, update the test data from the live server:
 
@@ -79,3 +213,8 @@ def _get_inventory_doc(inventory_xml_filename):
     path = os.path.abspath(os.path.join(os.path.dirname(__file__), 'data'))
     filepath = os.path.join(path, inventory_xml_filename)
     return InventoryDocument(open(filepath, 'r').read())
+
+
+def _get_inventory_stream(inventory_xml_filename):
+    path = os.path.abspath(os.path.join(os.path.dirname(__file__), 'data'))
+    return InventoryStream(os.path.join(path, inventory_xml_filename))
@@ -0,0 +1,61 @@
+from mock import patch
+from nose.tools import assert_equal, assert_raises
+
+from ckan import model
+from ckan.new_tests import factories
+from ckanext.dgulocal.lib.names import (NameReservations,
+                                        name_reservation_table,
+                                        init_name_reservation_table)
+
+
+class TestNameReservations:
+
+    @classmethod
+    def setup_class(cls):
+        init_name_reservation_table(model.meta.engine)
+
+    def teardown(self):
+        model.meta.engine.execute(name_reservation_table.delete())
+
+    def test_reserve(self):
+        names = NameReservations().for_job('job1')
+        assert_equal(names.reserve('Payments over 500 PCC'),
+                     'payments-over-500-pcc')
+        assert_equal(names.reserve('Payments over 500 PCC'),
+                     'payments-over-500-pcc1')
+
+    def test_avoids_existing_packages(self):
+        factories.Dataset(name='spending-data-abc')
+        factories.Dataset(name='spending-data-abc1')
+        names = NameReservations().for_job('job1')
+        assert_equal(names.reserve('Spending data ABC'),
+                     'spending-data-abc2')
+
+    def test_concurrent_jobs(self):
+        names1 = NameReservations().for_job('job1')
+        names2 = NameReservations().for_job('job2')
+        # both load the taken names before either reserves one
+        names1._taken['toilets-xyz'] = names1._load_taken('toilets-xyz')
+        names2._taken['toilets-xyz'] = names2._load_taken('toilets-xyz')
+        assert_equal(names1.reserve('Toilets XYZ'), 'toilets-xyz')
+        assert_equal(names2.reserve('Toilets XYZ'), 'toilets-xyz1')
+
+    def test_new_job(self):
+        names = NameReservations().for_job('job1')
+        assert_equal(names.reserve('Parks DEF'), 'parks-def')
+        model.meta.engine.execute(name_reservation_table.delete())
+        assert_equal(names.for_job('job2').reserve('Parks DEF'), 'parks-def')
+
+    def test_truncated_slug(self):
+        # munge_title_to_name truncates the slug to 100 characters, so the
+        # counter replaces its last characters
+        factories.Dataset(name='x' * 100)
+        factories.Dataset(name='x' * 99 + '1')
+        names = NameReservations().for_job('job1')
+        assert_equal(names.reserve('X' * 120), 'x' * 99 + '2')
+
+    def test_no_reservation_table(self):
+        names = NameReservations().for_job('job1')
+        with patch.object(name_reservation_table, 'exists',
+                          return_value=False):
+            assert_raises(Exception, names.reserve, 'Parks DEF')
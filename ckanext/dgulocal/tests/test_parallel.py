@@ -0,0 +1,56 @@
+from mock import Mock, patch
+from nose.tools import assert_equal
+
+from ckan import model
+from ckanext.harvest.model import HarvestSource, HarvestJob, HarvestObject
+from ckanext.dgulocal.lib import parallel
+
+
+class TestImportObject:
+
+    def setup(self):
+        source = HarvestSource(url=u'http://test.com/inventory.xml',
+                               type=u'inventory')
+        source.save()
+        job = HarvestJob(source=source)
+        job.save()
+        obj = HarvestObject(guid=u'testguid', job=job, content=u'<x/>',
+                            state=u'WAITING')
+        obj.save()
+        self.object_id = obj.id
+        self.harvester = Mock()
+        self.harvester.fetch_stage.return_value = True
+        self.harvester.import_stage.return_value = True
+
+    def teardown(self):
+        model.repo.rebuild_db()
+
+    def _import(self):
+        with patch.object(parallel, '_harvester', self.harvester):
+            return parallel._import_object(self.object_id)
+
+    def _state(self):
+        return HarvestObject.get(self.object_id).state
+
+    def test_complete(self):
+        assert_equal(self._import(), (self.object_id, u'COMPLETE'))
+        assert_equal(self._state(), u'COMPLETE')
+        assert self.harvester.import_stage.called
+
+    def test_import_fails(self):
+        self.harvester.import_stage.return_value = False
+        assert_equal(self._import(), (self.object_id, u'ERROR'))
+        assert_equal(self._state(), u'ERROR')
+
+    def test_skips_object_not_waiting(self):
+        obj = HarvestObject.get(self.object_id)
+        obj.state = u'IMPORT'
+        obj.save()
+        assert_equal(self._import(), (self.object_id, 'SKIPPED'))
+        assert not self.harvester.fetch_stage.called
+        assert_equal(self._state(), u'IMPORT')
+
+    def test_exception_marks_error(self):
+        self.harvester.import_stage.side_effect = Exception('boom')
+        assert_equal(self._import(), (self.object_id, u'ERROR'))
+        assert_equal(self._state(), u'ERROR')
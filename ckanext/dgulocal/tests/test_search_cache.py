@@ -0,0 +1,57 @@
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_equal
+
+from ckanext.dgulocal.lib.search_cache import SearchCache, normalize_search
+
+
+class TestNormalizeSearch:
+
+    def test_filter_order(self):
+        assert_equal(
+            normalize_search([('q', ' '), ('function', 'http://id.esd.org.uk/function/1'), ('service', 'a b')]),
+            normalize_search([('service', 'a b'), ('q', ''), ('function', 'http://id.esd.org.uk/function/1')]))
+
+    def test_fq_order(self):
+        assert_equal(
+            normalize_search([('fq', 'function:"http://id.esd.org.uk/function/1" service:"a b"')]),
+            normalize_search([('fq', 'service:"a b" function:"http://id.esd.org.uk/function/1"')]))
+
+    def test_fq_or_and_parentheses_not_reordered(self):
+        assert normalize_search([('fq', 'a:1 OR b:2 c:3')]) != \
+            normalize_search([('fq', 'a:1 b:2 OR c:3')])
+        assert normalize_search([('fq', '(a:1 OR b:2) c:3')]) != \
+            normalize_search([('fq', '(a:1 c:3 OR b:2)')])
+        assert normalize_search([('fq', 'a:"1" OR b:"2" c:"3"')]) != \
+            normalize_search([('fq', 'c:"3" OR b:"2" a:"1"')])
+        assert normalize_search([('q', 'parking OR bins')]) != \
+            normalize_search([('q', 'bins OR parking')])
+
+    def test_different_searches(self):
+        assert normalize_search([('q', 'parking')]) != \
+            normalize_search([('q', 'parking'), ('page', '2')])
+
+
+class TestSearchCache:
+
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.stamp_file = os.path.join(self.tmp_dir, 'stamp')
+        self.cache = SearchCache(ttl=60, stamp_file=self.stamp_file)
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_cached(self):
+        assert_equal(self.cache.search([('q', '')], lambda: 1), 1)
+        assert_equal(self.cache.search([('q', '')], lambda: 2), 1)
+        assert_equal(self.cache.stats()['hit_rate'], 0.5)
+
+    def test_invalidated_by_stamp(self):
+        self.cache.search([('q', '')], lambda: 1)
+        with open(self.stamp_file, 'w'):
+            pass
+        assert_equal(self.cache.search([('q', '')], lambda: 2), 2)
+        assert_equal(self.cache.search([('q', '')], lambda: 3), 2)
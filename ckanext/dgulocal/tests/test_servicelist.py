@@ -1,4 +1,8 @@
 import os
+import shutil
+import tempfile
+
+from mock import patch
 
 import ckanext.dgulocal.lib.services as services
 
@@ -17,3 +21,120 @@ class TestServiceList:
         assert_equal(len(data), 2)
         assert_equal(len(data.get('functions',{})), 113)
         assert_equal(len(data.get('services',{})), 1127)
+
+
+class TestEsdRegistry:
+
+    def setup(self):
+        self.index_dir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.index_dir)
+
+    def test_parse(self):
+        registry = services.EsdRegistry.parse(services.BUNDLED_FILE)
+        assert_equal(len(registry.functions), 113)
+        assert_equal(len(registry.services), 1127)
+        service = registry.get('http://id.esd.org.uk/service/190')
+        assert_equal(service.label, 'Benefits advice and assessment')
+        assert_equal(service.parent, 'http://id.esd.org.uk/function/2')
+        function = registry.get('http://id.esd.org.uk/function/2/')
+        assert_equal(function.label, 'Advice and welfare rights')
+        assert_equal(function.parent, 'http://id.esd.org.uk/function/1')
+        assert_equal(registry.get('http://id.esd.org.uk/function/1').parent,
+                     None)
+        assert_equal(registry.label('http://id.esd.org.uk/service/0', 'x'),
+                     'x')
+
+    def test_index_file(self):
+        registry = services.build_registry(self.index_dir)
+        assert os.path.exists(os.path.join(self.index_dir, 'index.json'))
+        with patch.object(services.EsdRegistry, 'parse') as parse:
+            reloaded = services.build_registry(self.index_dir)
+            assert not parse.called
+        assert_equal(reloaded.functions, registry.functions)
+        assert_equal(reloaded.services, registry.services)
+
+    def test_index_rebuilt_when_source_changes(self):
+        source = os.path.join(self.index_dir, 'functions_services.xml')
+        shutil.copy(services.BUNDLED_FILE, source)
+        services.build_registry(self.index_dir)
+        with open(source, 'w') as f:
+            f.write('<Functions><Function><URI>http://id.esd.org.uk/function/1'
+                    '</URI><Label>Only</Label></Function></Functions>')
+        registry = services.build_registry(self.index_dir)
+        assert_equal(registry.functions.keys(),
+                     ['http://id.esd.org.uk/function/1'])
+
+
+class TestEsdHierarchy:
+
+    @classmethod
+    def setup_class(cls):
+        registry = services.EsdRegistry.parse(services.BUNDLED_FILE)
+        cls.hierarchy = registry.hierarchy
+
+    def test_ancestor_functions(self):
+        assert_equal(self.hierarchy.ancestor_functions(
+                         'http://id.esd.org.uk/service/190'),
+                     ['http://id.esd.org.uk/function/2',
+                      'http://id.esd.org.uk/function/1'])
+        assert_equal(self.hierarchy.ancestor_functions(
+                         'http://id.esd.org.uk/function/1'), [])
+        assert_equal(self.hierarchy.ancestor_functions('unknown'), [])
+
+    def test_descendant_services(self):
+        advice = self.hierarchy.descendant_services(
+            'http://id.esd.org.uk/function/1')
+        assert 'http://id.esd.org.uk/service/190' in advice
+        assert all('/service/' in uri for uri in advice)
+        assert 'http://id.esd.org.uk/function/2' in \
+            self.hierarchy.descendants('http://id.esd.org.uk/function/1')
+        assert_equal(self.hierarchy.descendant_services(
+                         'http://id.esd.org.uk/service/190'), [])
+
+    def test_closure_is_consistent(self):
+        for uri in self.hierarchy.uris:
+            for ancestor in self.hierarchy.ancestor_functions(uri):
+                assert uri in self.hierarchy.descendants(ancestor)
+
+    def test_all_services_under_top_level_functions(self):
+        top_level = [uri for uri in self.hierarchy.uris
+                     if '/function/' in uri
+                     and not self.hierarchy.ancestor_functions(uri)]
+        services_found = set()
+        for uri in top_level:
+            services_found.update(self.hierarchy.descendant_services(uri))
+        assert_equal(len(services_found), 1127)
+
+
+class TestFacetValues:
+
+    @classmethod
+    def setup_class(cls):
+        cls.registry = services.EsdRegistry.parse(services.BUNDLED_FILE)
+
+    def test_adds_ancestor_functions(self):
+        values = services.facet_values(
+            'http://id.esd.org.uk/service/190 http://id.esd.org.uk/service/190/',
+            'http://id.esd.org.uk/function/2', self.registry)
+        assert_equal(values['service'], ['http://id.esd.org.uk/service/190'])
+        assert_equal(values['function'], ['http://id.esd.org.uk/function/2',
+                                          'http://id.esd.org.uk/function/1'])
+
+    def test_empty(self):
+        assert_equal(services.facet_values('', None, self.registry),
+                     {'service': [], 'function': []})
+
+
+class TestLabelTable:
+
+    def test_get(self):
+        labels = services.LabelTable(
+            services.EsdRegistry.parse(services.BUNDLED_FILE))
+        assert_equal(len(labels), 1240)
+        assert_equal(labels.get('http://id.esd.org.uk/service/190'),
+                     'Benefits advice and assessment')
+        assert_equal(labels.get(' http://id.esd.org.uk/function/1/'),
+                     'Advice and benefits')
+        assert_equal(labels.get('http://id.esd.org.uk/service/0', 'x'), 'x')
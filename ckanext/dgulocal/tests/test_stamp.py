@@ -0,0 +1,25 @@
+import os
+import shutil
+import tempfile
+
+from nose.tools import assert_equal
+
+from ckanext.dgulocal.lib.stamp import ChangeStamp
+
+
+class TestChangeStamp:
+
+    def setup(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'stamp')
+
+    def teardown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_changed(self):
+        stamp = ChangeStamp(self.path)
+        assert_equal(stamp.changed(), False)
+        # touched by another process
+        ChangeStamp(self.path).touch()
+        assert_equal(stamp.changed(), True)
+        assert_equal(stamp.changed(), False)
@@ -0,0 +1,28 @@
+from nose.tools import assert_equal
+
+from ckanext.dgulocal.lib.themes import theme_index, themes_for_uris
+
+
+class TestThemes:
+
+    def test_index(self):
+        index = theme_index()
+        assert index is theme_index()
+        assert_equal(index['http://id.esd.org.uk/service/199'], ('Health',))
+        assert_equal(index['http://id.esd.org.uk/function/24'],
+                     ('Education',))
+
+    def test_themes_for_uris(self):
+        # service first, then function; names mapped to DGU themes
+        assert_equal(themes_for_uris(['http://id.esd.org.uk/service/199',
+                                      'http://id.esd.org.uk/function/24',
+                                      'http://id.esd.org.uk/service/1200']),
+                     ['Health', 'Education', 'Economy & Business'])
+
+    def test_themes_no_duplicates(self):
+        assert_equal(themes_for_uris(['http://id.esd.org.uk/function/24',
+                                      'http://id.esd.org.uk/function/25']),
+                     ['Education'])
+
+    def test_unknown(self):
+        assert_equal(themes_for_uris(['http://id.esd.org.uk/service/0']), [])
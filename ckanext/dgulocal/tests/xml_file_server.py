@@ -1,4 +1,5 @@
 import os
+import email.utils
 
 import SimpleHTTPServer
 import SocketServer
@@ -7,23 +8,46 @@ from threading import Thread
 
 PORT = 8999
 
+_httpd = None
+
 def serve(port=PORT):
     '''Serves test XML files over HTTP'''
-    
+    global _httpd
+    if _httpd:
+        # already serving, e.g. imported by another test module
+        return
+
     # Make sure we serve from the tests' XML directory
     os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)),
                           'data'))
 
-    Handler = SimpleHTTPServer.SimpleHTTPRequestHandler
+    Handler = ConditionalRequestHandler
     
     class TestServer(SocketServer.TCPServer):
         allow_reuse_address = True
     
-    httpd = TestServer(("", PORT), Handler)
-    
+    httpd = _httpd = TestServer(("", PORT), Handler)
+
     print 'Serving test HTTP server at port', PORT
 
     httpd_thread = Thread(target=httpd.serve_forever)
     httpd_thread.setDaemon(True)
     httpd_thread.start()
 
+
+
+class ConditionalRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    '''Replies 304 Not Modified when If-Modified-Since is not before the
+    file's modification time, which SimpleHTTPRequestHandler ignores'''
+
+    def send_head(self):
+        since = self.headers.get('If-Modified-Since')
+        path = self.translate_path(self.path)
+        if since and os.path.isfile(path):
+            since_time = email.utils.parsedate_tz(since)
+            if since_time and \
+                    int(os.stat(path).st_mtime) <= email.utils.mktime_tz(since_time):
+                self.send_response(304)
+                self.end_headers()
+                return None
+        return SimpleHTTPServer.SimpleHTTPRequestHandler.send_head(self)
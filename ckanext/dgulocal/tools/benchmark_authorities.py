@@ -0,0 +1,52 @@
+"""
+Micro-benchmark of local_authority_for_point lookups in the AuthorityIndex,
+using synthetic jagged circular boundaries laid out in a grid.
+
+Usage:
+
+    python ckanext/dgulocal/tools/benchmark_authorities.py [authorities] [vertices] [lookups]
+
+It defaults to 400 authorities of 5,000 vertices each, and reports lookups/sec.
+"""
+import math
+import random
+import sys
+import time
+
+from shapely.geometry import Polygon
+
+from ckanext.dgulocal.lib.authorities import AuthorityIndex
+
+
+def synthetic_extents(authorities, vertices):
+    random.seed(0)
+    extents = []
+    for k in xrange(authorities):
+        lat, lng = 50 + (k % 20) * 0.25, -4 + (k // 20) * 0.25
+        coords = []
+        for i in xrange(vertices):
+            angle = 2 * math.pi * i / vertices
+            radius = 0.12 * (1 + 0.05 * random.random())
+            coords.append((lat + radius * math.sin(angle),
+                           lng + radius * math.cos(angle)))
+        extents.append((str(k), Polygon(coords)))
+    return extents
+
+
+if __name__ == "__main__":
+    authorities = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+    vertices = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    lookups = int(sys.argv[3]) if len(sys.argv) > 3 else 20000
+
+    extents = synthetic_extents(authorities, vertices)
+    start = time.time()
+    index = AuthorityIndex(extents)
+    print 'Built index of %s boundaries of %s vertices in %.3f sec' % (
+        authorities, vertices, time.time() - start)
+
+    points = [(50 + random.random() * 5, -4 + random.random() * 5)
+              for i in xrange(lookups)]
+    start = time.time()
+    for lat, lng in points:
+        index.lookup(lat, lng)
+    print '%10.0f lookups/sec' % (lookups / (time.time() - start))
@@ -0,0 +1,76 @@
+"""
+Micro-benchmark of parsing a boundary's hasExteriorLatLongPolygon string into
+a Shapely Polygon, comparing the NumPy parser (geo.parse_coordinates) with
+the previous implementation, which split the string and called float() on
+each coordinate pair in a Python generator.
+
+Usage:
+
+    python ckanext/dgulocal/tools/benchmark_boundary.py [vertices] [repeats]
+
+It defaults to a synthetic boundary of 500,000 vertices, about the size of
+a coastal authority's, and reports the best time of each implementation.
+"""
+import math
+import random
+import sys
+import time
+
+from shapely.geometry import Polygon
+
+from ckanext.dgulocal.lib.geo import parse_coordinates
+
+
+def synthetic_boundary(vertices):
+    '''A jagged ring of lat/long pairs around Peterborough, as a string'''
+    random.seed(0)
+    coords = []
+    for i in xrange(vertices - 1):
+        angle = 2 * math.pi * i / (vertices - 1)
+        radius = 0.1 + random.random() * 0.01
+        coords.append('%.7f %.7f' % (52.57 + radius * math.sin(angle),
+                                     -0.24 + radius * math.cos(angle)))
+    coords.append(coords[0])
+    return ' '.join(coords)
+
+
+def legacy_polygon(boundary):
+    '''The previous implementation, kept for comparison'''
+    def chunk(l):
+        for i in xrange(0, len(l), 2):
+            lat = l[i:i+1][0]
+            lng = l[i+1:i+2][0]
+            yield (float(lat), float(lng))
+
+    return Polygon([c for c in chunk(boundary.strip().split(' '))])
+
+
+def numpy_polygon(boundary):
+    return Polygon(parse_coordinates(boundary))
+
+
+def best_time(func, boundary, repeats):
+    times = []
+    for i in xrange(repeats):
+        start = time.time()
+        func(boundary)
+        times.append(time.time() - start)
+    return min(times)
+
+
+if __name__ == "__main__":
+    vertices = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    boundary = synthetic_boundary(vertices)
+    assert list(legacy_polygon(boundary).exterior.coords) == \
+        list(numpy_polygon(boundary).exterior.coords), \
+        'Implementations disagree'
+
+    print 'Synthetic boundary: %s vertices, %.1f MB' % (
+        vertices, len(boundary) / 1024.0 / 1024)
+    before = best_time(legacy_polygon, boundary, repeats)
+    after = best_time(numpy_polygon, boundary, repeats)
+    print 'before (float() per pair): %8.3f sec' % before
+    print 'after (numpy):             %8.3f sec' % after
+    print 'speedup: %.1fx' % (before / after)
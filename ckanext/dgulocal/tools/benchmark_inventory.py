@@ -0,0 +1,92 @@
+"""
+Micro-benchmark of InventoryDocument.dataset_to_dict, comparing the
+single-pass field extraction with the previous implementation, which ran a
+separate node.xpath() query for every field.
+
+Usage:
+
+    python ckanext/dgulocal/tools/benchmark_inventory.py [inventory.xml] [seconds]
+
+It defaults to the tests' esdInventory_live.xml and reports datasets/sec
+for each implementation.
+"""
+import HTMLParser
+import datetime
+import os
+import sys
+import time
+
+from ckanext.dgulocal.lib.inventory import InventoryDocument, NSMAP
+
+BASE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_INPUT = os.path.abspath(
+    os.path.join(BASE, '..', 'tests', 'data', 'esdInventory_live.xml'))
+
+
+def _get_node_text(node, default=''):
+    if node:
+        return node[0].text
+    return default
+
+
+def legacy_dataset_to_dict(node):
+    '''The per-field xpath implementation, kept for comparison'''
+    d = {}
+    d['identifier'] = _get_node_text(node.xpath('inv:Identifier', namespaces=NSMAP))
+    d['title'] = _get_node_text(node.xpath('inv:Title', namespaces=NSMAP))
+    modified_str = node.get('Modified')
+    d['modified'] = datetime.datetime.strptime(modified_str, '%Y-%m-%d').date() if modified_str else None
+    d['active'] = node.get('Active') in ['True', 'Yes']
+    d['description'] = _get_node_text(node.xpath('inv:Description', namespaces=NSMAP))
+    d['rights'] = _get_node_text(node.xpath('inv:Rights', namespaces=NSMAP))
+    if d['rights'] == 'http://www.nationalarchives.gov.uk/doc/open-government-licence':
+        d['rights'] = 'http://www.nationalarchives.gov.uk/doc/open-government-licence/version/2/'
+    h = HTMLParser.HTMLParser()
+    d['description'] = h.unescape(d.get('description', ''))
+    svc = _get_node_text(node.xpath('inv:Subjects/inv:Subject/inv:Service', namespaces=NSMAP))
+    fn = _get_node_text(node.xpath('inv:Subjects/inv:Subject/inv:Function', namespaces=NSMAP))
+    d['services'] = [svc] if svc else []
+    d['functions'] = [fn] if fn else []
+    d['resources'] = []
+    for resnode in node.xpath('inv:Resources/inv:Resource', namespaces=NSMAP):
+        for n in resnode.xpath('inv:Renditions/inv:Rendition', namespaces=NSMAP):
+            res = {}
+            res['url'] = _get_node_text(n.xpath('inv:Identifier', namespaces=NSMAP))
+            res['active'] = n.get('Active') in ['Yes', 'True', '', None]
+            res['resource_type'] = n.get('Type')
+            res['title'] = _get_node_text(n.xpath('inv:Title', namespaces=NSMAP))
+            res['description'] = _get_node_text(n.xpath('inv:Description', namespaces=NSMAP))
+            res['mimetype'] = _get_node_text(n.xpath('inv:MimeType', namespaces=NSMAP))
+            res['availability'] = _get_node_text(n.xpath('inv:Availability', namespaces=NSMAP))
+            res['conforms_to'] = _get_node_text(n.xpath('inv:ConformsTo', namespaces=NSMAP))
+            d['resources'].append(res)
+    return d
+
+
+def datasets_per_second(func, nodes, seconds):
+    count = 0
+    start = time.time()
+    while time.time() - start < seconds:
+        for node in nodes:
+            func(node)
+        count += len(nodes)
+    return count / (time.time() - start)
+
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_INPUT
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 2.0
+
+    doc = InventoryDocument(open(path, 'r').read())
+    nodes = list(doc.dataset_nodes())
+    for node in nodes:
+        assert InventoryDocument.dataset_to_dict(node) == \
+            legacy_dataset_to_dict(node), 'Implementations disagree'
+
+    print '%s: %s datasets' % (os.path.basename(path), len(nodes))
+    before = datasets_per_second(legacy_dataset_to_dict, nodes, seconds)
+    after = datasets_per_second(InventoryDocument.dataset_to_dict, nodes,
+                                seconds)
+    print 'before (xpath per field): %10.0f datasets/sec' % before
+    print 'after (single pass):      %10.0f datasets/sec' % after
+    print 'speedup: %.1fx' % (after / before)
@@ -18,6 +18,8 @@ import os
 import pprint
 import sys
 
+from ckanext.dgulocal.lib.themes import THEME_NAME_MAP
+
 BASE = os.path.dirname(os.path.abspath(__file__))
 INPUT = os.path.abspath(os.path.join(BASE, '..', 'data/functions_services_themes.csv'))
 
@@ -38,18 +40,7 @@ if __name__ == "__main__":
     s_theme_map = collections.defaultdict(set)
 
     # LGA provided CSV doesn't use the list we sent
-    lookup_map = {
-        'Crime and justice': 'Crime & Justice',
-        'Health': 'Health',
-        'Government': 'Government',
-        'Towns and cities': 'Towns & Cities',
-        'Environment': 'Environment',
-        'Society':'Society',
-        'Government spending': 'Government Spending',
-        'Business and economy': 'Economy & Business',
-        'Education': 'Education',
-        'Transport': 'Transport'
-    }
+    lookup_map = THEME_NAME_MAP
 
     for row in reader:
         function_id = row.get('Identifier', '')
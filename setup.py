@@ -22,7 +22,8 @@ setup(
         "requests>=1.1.0",
         "lxml>=2.2.4",
         "GeoAlchemy>=0.6",
-        "Shapely>=1.2.13"
+        "Shapely>=1.4",
+        "numpy>=1.6"
     ],
     entry_points=\
     """